@@ -0,0 +1,158 @@
+import threading
+from collections import OrderedDict
+
+#######################################################################################################
+#
+#  LRUCache
+#
+#######################################################################################################
+class LRUCache:
+    """Thread-safe LRU cache bounded by number of entries and, optionally, by total size.
+
+    Args:
+        max_entries: maximum number of entries. The least recently used ones are evicted first.
+        max_bytes: maximum total size of the entries, as given to put(). None means unbounded.
+    """
+    def __init__(self, max_entries=128, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, record=True):
+        """Return the value cached for key, or None. Counts a hit or a miss unless record is False."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += record
+                return None
+            self._entries.move_to_end(key)
+            self._hits += record
+            return entry[0]
+
+    def put(self, key, value, size=0):
+        """Cache value for key, evicting the least recently used entries beyond max_entries or max_bytes.
+
+        A value larger than max_bytes on its own is not cached.
+        """
+        with self._lock:
+            self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+                self._evictions += 1
+
+    def pop(self, key):
+        """Remove key from the cache and return its value, or None."""
+        with self._lock:
+            return self._remove(key)
+
+    def record(self, hit):
+        """Count a hit (or a miss) decided by the caller, e.g. after revalidating an entry got with record=False."""
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = self._hits = self._misses = self._evictions = 0
+
+    def stats(self):
+        """Return the cache counters: { 'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0 }"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._bytes -= entry[1]
+        return entry[0]
+
+    def __len__(self):
+        return len(self._entries)
+
+#######################################################################################################
+#
+#  FrozenDict
+#
+#######################################################################################################
+class FrozenDict(dict):
+    """Read-only dict handed out by caches, so callers cannot modify the cached value.
+
+    It is still a dict for json.dumps() and isinstance() checks. copy.deepcopy() returns a mutable
+    copy (see thaw).
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError(f"'{type(self).__name__}' object is read-only, use copy.deepcopy() to get a mutable copy")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (dict, (thaw(self),))
+
+#######################################################################################################
+#
+#  FrozenList
+#
+#######################################################################################################
+class FrozenList(list):
+    """Read-only list handed out by caches. See FrozenDict."""
+    def _readonly(self, *args, **kwargs):
+        raise TypeError(f"'{type(self).__name__}' object is read-only, use copy.deepcopy() to get a mutable copy")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = clear = extend = insert = pop = remove = reverse = sort = _readonly
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (list, (thaw(self),))
+
+#######################################################################################################
+#
+#  freeze
+#
+#######################################################################################################
+def freeze(value):
+    """Return a read-only copy of a json-like value: dicts and lists become FrozenDict and FrozenList."""
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(item) for item in value)
+    return value
+
+#######################################################################################################
+#
+#  thaw
+#
+#######################################################################################################
+def thaw(value):
+    """Return a mutable copy of a json-like value, e.g. of a value returned by freeze()."""
+    if isinstance(value, dict):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [thaw(item) for item in value]
+    return value
@@ -0,0 +1,123 @@
+import threading
+from .safe_kwargs import safe_kwargs
+
+DEFAULT_CONFIG = {
+    'region_name': None,
+    'max_pool_connections': 50,
+    'retry_mode': 'standard',
+    'max_attempts': 5
+}
+
+_lock = threading.Lock()
+_config = dict(DEFAULT_CONFIG)
+_session = None
+_clients = {}
+
+#######################################################################################################
+#
+#  configure
+#
+#######################################################################################################
+@safe_kwargs({
+    'region_name': {'type': 'string', 'nullable': True, 'doc': 'AWS region. None uses the default boto3 lookup.'},
+    'max_pool_connections': {'type': 'integer', 'doc': 'maximum number of connections kept by each client.'},
+    'retry_mode': {'type': 'string', 'allowed': ['legacy', 'standard', 'adaptive'], 'doc': 'botocore retry mode.'},
+    'max_attempts': {'type': 'integer', 'doc': 'maximum number of attempts of each request, retries included.'}
+}, engine='compiled')
+def configure(**kwargs):
+    """Configure the boto3 clients shared by the awsomeutils modules.
+
+    Cached clients are dropped, so the next get_client() call creates them with the new settings.
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs.
+
+    Returns:
+        The current configuration dict.
+    """
+    with _lock:
+        _config.update({key: kwargs[key] for key in DEFAULT_CONFIG if key in kwargs})
+        _clients.clear()
+        return dict(_config)
+
+#######################################################################################################
+#
+#  get_client
+#
+#######################################################################################################
+def get_client(service_name):
+    """Return the shared boto3 client of an AWS service, creating it on first use.
+
+    boto3 clients are thread-safe and keep their connection pool, so reusing them keeps TCP/TLS
+    connections alive across calls and warm Lambda invocations.
+
+    Args:
+        service_name: AWS service name, e.g. 's3'.
+
+    Returns:
+        A boto3 client.
+    """
+    client = _clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = _clients[service_name] = _create_client(service_name)
+    return client
+
+#######################################################################################################
+#
+#  set_client
+#
+#######################################################################################################
+def set_client(service_name, client):
+    """Replace the shared client of an AWS service, e.g. with a client created under a moto mock.
+
+    Args:
+        service_name: AWS service name, e.g. 's3'.
+        client: boto3 client, or None to drop the current one.
+    """
+    with _lock:
+        if client is None:
+            _clients.pop(service_name, None)
+        else:
+            _clients[service_name] = client
+
+#######################################################################################################
+#
+#  reset
+#
+#######################################################################################################
+def reset():
+    """Drop the shared session and clients and restore the default configuration."""
+    global _session
+    with _lock:
+        _config.clear()
+        _config.update(DEFAULT_CONFIG)
+        _clients.clear()
+        _session = None
+
+#------------------------------------------------------------------------------------------------------
+#  _create_client
+#------------------------------------------------------------------------------------------------------
+def _create_client(service_name):
+    import boto3
+    from botocore.config import Config
+    global _session
+
+    if _session is None:
+        _session = boto3.session.Session()
+
+    config = Config(
+        region_name=_config['region_name'],
+        max_pool_connections=_config['max_pool_connections'],
+        retries={'mode': _config['retry_mode'], 'total_max_attempts': _config['max_attempts']}
+    )
+
+    return _session.client(service_name, config=config)
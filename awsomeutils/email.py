@@ -1,8 +1,383 @@
-import smtplib
-from email.message import EmailMessage
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from collections.abc import Mapping
+from queue import Full, Queue
+from .clients import get_client
 from .safe_kwargs import safe_kwargs
+from .template import compile_template
 
 EMAIL_REGEX = r'(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)'
+MESSAGE_SCHEMA = {
+    'email': {'required': True, 'type': 'string', 'regex': EMAIL_REGEX, 'doc': 'Receiver\'s e-mail address'},
+    'subject': {'required': True, 'type': 'string'},
+    'body': {'required': True, 'type': 'string'}
+}
+EMAIL_PATTERN = re.compile(EMAIL_REGEX)
+ATTACHMENT_SCHEMA = {
+    'bucket_name': {'required': True, 'type': 'string', 'doc': 'S3 bucket name'},
+    'file_key': {'required': True, 'type': 'string', 'doc': 'S3 key of the attached file'},
+    'file_name': {'type': 'string', 'doc': 'name of the attachment. Defaults to the last part of file_key.'},
+    'content_type': {'type': 'string', 'doc': 'MIME type of the attachment. Defaults to a guess from file_name.'}
+}
+
+# Invariant headers of a text/plain part, as written by EmailMessage.set_content().
+TEXT_HEADERS = 'Content-Type: text/plain; charset="utf-8"\nContent-Transfer-Encoding: {}\n'
+TEXT_7BIT_HEADERS = TEXT_HEADERS.format('7bit')
+TEXT_BASE64_HEADERS = TEXT_HEADERS.format('base64')
+MIME_VERSION_HEADER = 'MIME-Version: 1.0\n'
+# Attachments are read from S3 in chunks of whole base64 lines: 57 bytes encode to a 76-character line.
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+# Encoded chunks read ahead of the SMTP connection, which bounds the memory used by a message.
+ATTACHMENT_QUEUE_SIZE = 16
+# Lines too long for 7bit.
+LONG_LINE_REGEX = re.compile('[^\n]{79}')
+
+#######################################################################################################
+#
+#  SMTPPool
+#
+#######################################################################################################
+class SMTPPool:
+    """Thread-safe pool of authenticated SMTP_SSL connections, keyed by (host, port, user).
+
+    Connections are kept open between sends (and warm Lambda invocations), so the TLS handshake and
+    the login are paid once. A connection idle for more than check_interval is checked with NOOP
+    before being reused, and one idle for more than idle_timeout is closed.
+
+    Args:
+        idle_timeout: seconds after which an idle connection is closed.
+        check_interval: seconds of idleness after which a connection is checked with NOOP.
+        max_idle: maximum number of idle connections kept per (host, port, user).
+    """
+    def __init__(self, idle_timeout=60, check_interval=5, max_idle=4):
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._stats = {'connects': 0, 'reuses': 0, 'closes': 0}
+
+    def acquire(self, host, port, user, password):
+        """Return a live connection logged in as user: an idle one if any, otherwise a new one."""
+        key = (host, port, user)
+        secret = _password_digest(password)
+        self.close_idle()
+
+        while True:
+            with self._lock:
+                idle = self._idle.get(key, [])
+                if not idle:
+                    break
+                server, server_secret, released_at = idle.pop()
+
+            # A session logged in with another password is not handed out.
+            if server_secret == secret and (time.monotonic() - released_at < self.check_interval or _is_alive(server)):
+                with self._lock:
+                    self._stats['reuses'] += 1
+                return server
+            self._close(server)
+
+        return self.connect(host, port, user, password)
+
+    def connect(self, host, port, user, password):
+        """Open a new connection logged in as user, outside of the pool until release()."""
+        server = _open_server_connection(host, port, user, password)
+        with self._lock:
+            self._stats['connects'] += 1
+        return server
+
+    def release(self, host, port, user, password, server):
+        """Give a connection back to the pool, once the caller is done with it."""
+        key = (host, port, user)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((server, _password_digest(password), time.monotonic()))
+                return
+        self._close(server)
+
+    def discard(self, server):
+        """Close a connection that must not go back to the pool, e.g. after an error."""
+        self._close(server)
+
+    def close_idle(self, max_idle_time=None):
+        """Close the connections idle for more than max_idle_time seconds (idle_timeout by default)."""
+        limit = time.monotonic() - (self.idle_timeout if max_idle_time is None else max_idle_time)
+        expired = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                expired += [server for server, _, released_at in idle if released_at <= limit]
+                idle[:] = [entry for entry in idle if entry[2] > limit]
+        for server in expired:
+            self._close(server)
+
+    def close_all(self):
+        """Close all the idle connections."""
+        self.close_idle(max_idle_time=-1)
+
+    def stats(self):
+        """Return the pool counters: { 'idle': 0, 'connects': 0, 'reuses': 0, 'closes': 0 }"""
+        with self._lock:
+            return dict(self._stats, idle=sum(len(idle) for idle in self._idle.values()))
+
+    def _close(self, server):
+        with self._lock:
+            self._stats['closes'] += 1
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+# Connections shared by send().
+smtp_pool = SMTPPool()
+
+#######################################################################################################
+#
+#  Outbox
+#
+#######################################################################################################
+class Outbox:
+    """Durable spool of messages, sent in the background over pooled connections.
+
+    Messages are stored in a SQLite file before enqueue() returns, and a daemon thread sends them in
+    batches of batch_size, every flush_interval seconds or as soon as messages are enqueued. A message
+    that fails with a transient error is retried with exponential backoff (backoff * 2 ** attempts
+    seconds, at most max_backoff); one refused by the server (5xx reply) or failing max_attempts times
+    is kept as a dead letter. Passwords are only kept in memory: after a restart, the spooled messages
+    of a (host, port, user) are sent once a message is enqueued again with its password.
+
+    The file is only opened on first use. On Lambda, the thread is frozen between invocations: call
+    flush() before returning to send what is due. Several processes may share the file: each batch is
+    claimed before being sent, and the messages of a process that stopped while sending them are sent
+    again once lease seconds have passed.
+
+    Args:
+        path: SQLite file of the spool. Defaults to awsomeutils-outbox.sqlite3 in the temporary directory.
+        batch_size: maximum number of messages sent per batch.
+        max_attempts: attempts before a message becomes a dead letter.
+        backoff: seconds before the first retry, doubled at each attempt.
+        max_backoff: maximum seconds between two attempts.
+        flush_interval: seconds between two checks of the spool by the background thread.
+        lease: seconds a claimed batch is reserved to the process sending it.
+    """
+    def __init__(self, path=None, batch_size=50, max_attempts=5, backoff=2, max_backoff=300, flush_interval=1, lease=300):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.flush_interval = flush_interval
+        self.lease = lease
+        self._db = None
+        self._credentials = {}
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+        self._stats = {'sent': 0, 'retries': 0}
+        self._last_flush = None
+
+    def enqueue(self, host, port, user, password, message):
+        """Spool a message to be sent as user and return its id. The background thread is started if needed."""
+        with self._lock:
+            self._credentials[(host, port, user)] = password
+            with self._connection() as db:
+                cursor = db.execute(
+                    'INSERT INTO outbox (host, port, user, message, created, next_attempt) VALUES (?, ?, ?, ?, ?, ?)',
+                    (host, port, user, json.dumps(message), time.time(), 0))
+            if self._thread is None or not self._thread.is_alive():
+                self._closed = False
+                self._thread = threading.Thread(target=self._run, name='awsomeutils-outbox', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def flush(self):
+        """Send the due messages now, in the calling thread, and return the number of messages sent."""
+        sent = 0
+        while True:
+            batch_sent, batch_size = self._drain()
+            sent += batch_sent
+            if batch_size < self.batch_size:
+                return sent
+
+    def stats(self):
+        """Return the outbox counters: { 'pending': 0, 'dead': 0, 'lag': 0.0, 'sent': 0, 'retries': 0, 'last_flush': None }
+
+        lag is the age in seconds of the oldest pending message, last_flush the time of the last batch.
+        """
+        with self._lock:
+            with self._connection() as db:
+                pending, oldest = db.execute("SELECT COUNT(*), MIN(created) FROM outbox WHERE state IN ('pending', 'sending')").fetchone()
+                dead = db.execute("SELECT COUNT(*) FROM outbox WHERE state = 'dead'").fetchone()[0]
+            return {
+                'pending': pending,
+                'dead': dead,
+                'lag': 0.0 if oldest is None else time.time() - oldest,
+                'sent': self._stats['sent'],
+                'retries': self._stats['retries'],
+                'last_flush': self._last_flush
+            }
+
+    def dead_letters(self):
+        """Return the dead letters: [{ 'id': 1, 'message': {...}, 'attempts': 1, 'error': 'error message' }]"""
+        with self._lock:
+            with self._connection() as db:
+                rows = db.execute("SELECT id, message, attempts, error FROM outbox WHERE state = 'dead' ORDER BY id").fetchall()
+        return [{'id': id, 'message': json.loads(message), 'attempts': attempts, 'error': error} for id, message, attempts, error in rows]
+
+    def close(self):
+        """Stop the background thread. The pending messages stay in the spool."""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if not self._closed:
+                self.flush()
+
+    def _drain(self):
+        import smtplib
+        with self._drain_lock:
+            with self._lock:
+                credentials = dict(self._credentials)
+                if not credentials:
+                    return 0, 0
+                # Messages of a user whose password is not known yet wait for the next enqueue(). The batch is
+                # claimed in a single statement, so another process sharing the file cannot send it too; a
+                # claim whose lease has expired is taken over.
+                users = ' OR '.join(['(host = ? AND port = ? AND user = ?)'] * len(credentials))
+                claim, now = f"{os.getpid()}-{uuid.uuid4().hex}", time.time()
+                with self._connection() as db:
+                    db.execute(
+                        f"""UPDATE outbox SET state = 'sending', claim = ?, next_attempt = ? WHERE id IN (
+                            SELECT id FROM outbox WHERE state IN ('pending', 'sending') AND next_attempt <= ? AND ({users}) ORDER BY id LIMIT ?)""",
+                        (claim, now + self.lease, now, *(value for key in credentials for value in key), self.batch_size))
+                    rows = db.execute(
+                        "SELECT id, host, port, user, message, attempts FROM outbox WHERE state = 'sending' AND claim = ? ORDER BY id",
+                        (claim,)).fetchall()
+
+            done, failed = [], []
+            connection = key = None
+            unreachable = {}
+            for id, host, port, user, message, attempts in rows:
+                if (host, port, user) in unreachable:
+                    failed.append((id, attempts, False, unreachable[(host, port, user)]))
+                    continue
+
+                try:
+                    if key != (host, port, user):
+                        if connection is not None:
+                            connection.release()
+                        key = (host, port, user)
+                        connection = _PooledConnection(host, port, user, credentials[key])
+                    try:
+                        connection.open()
+                    except Exception as e:
+                        # Login or connection failures are retried later, without trying each message.
+                        unreachable[key] = str(e)
+                        raise
+                    message = json.loads(message)
+                    connection.send(lambda server: _send_message(server, user, message))
+                    done.append(id)
+
+                except smtplib.SMTPRecipientsRefused as e:
+                    code, response = next(iter(e.recipients.values()))
+                    failed.append((id, attempts, code >= 500, f"{code} {_decode_reply(response)}"))
+
+                except smtplib.SMTPResponseException as e:
+                    # A 5xx reply to the message itself is permanent, anything else is retried.
+                    permanent = (host, port, user) not in unreachable and e.smtp_code >= 500
+                    failed.append((id, attempts, permanent, f"{e.smtp_code} {_decode_reply(e.smtp_error)}"))
+
+                except Exception as e:
+                    failed.append((id, attempts, False, str(e)))
+
+            if connection is not None:
+                connection.release()
+
+            now = time.time()
+            with self._lock:
+                with self._connection() as db:
+                    db.executemany('DELETE FROM outbox WHERE id = ?', [(id,) for id in done])
+                    for id, attempts, permanent, error in failed:
+                        attempts += 1
+                        if permanent or attempts >= self.max_attempts:
+                            db.execute("UPDATE outbox SET state = 'dead', attempts = ?, error = ? WHERE id = ?", (attempts, error, id))
+                        else:
+                            self._stats['retries'] += 1
+                            delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+                            db.execute("UPDATE outbox SET state = 'pending', attempts = ?, error = ?, next_attempt = ? WHERE id = ?", (attempts, error, now + delay, id))
+                self._stats['sent'] += len(done)
+                if rows:
+                    self._last_flush = now
+
+            return len(done), len(rows)
+
+    def _connection(self):
+        # Called with self._lock held. The connection commits on exiting a with block.
+        if self._db is None:
+            import sqlite3
+            if self.path is None:
+                import tempfile
+                self.path = os.path.join(tempfile.gettempdir(), 'awsomeutils-outbox.sqlite3')
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                host TEXT, port INTEGER, user TEXT, message TEXT,
+                created REAL, next_attempt REAL, attempts INTEGER DEFAULT 0,
+                state TEXT DEFAULT 'pending', error TEXT, claim TEXT)""")
+            self._db = db
+        return self._db
+
+# Messages spooled by send(outbox=True).
+outbox = Outbox()
+
+#######################################################################################################
+#
+#  MailTemplate
+#
+#######################################################################################################
+class MailTemplate:
+    """Subject and body templates (string.Template syntax) parsed once, rendering a message per recipient.
+
+    render() only fills the placeholders and joins the result with the invariant headers, which are
+    built once. The message is the one built by _build_message(), except that a body that cannot be
+    sent as 7bit (non-ASCII text or lines longer than 78 characters) is always encoded in base64,
+    where EmailMessage may choose quoted-printable. A subject that is not short printable ASCII is
+    encoded by the email package.
+
+    Args:
+        subject: subject template.
+        body: body template.
+    """
+    def __init__(self, subject, body):
+        self.subject = compile_template(subject)
+        self.body = compile_template(body)
+
+    def render(self, mapping):
+        """Return the message text for mapping, as expected by smtplib's sendmail().
+
+        Raises:
+            ValueError: if the subject contains a line break once substituted.
+        """
+        headers, content = _text_part(self.body.substitute(mapping))
+        return ''.join((_subject_header(self.subject.substitute(mapping)), headers, MIME_VERSION_HEADER, '\n', content))
 
 #######################################################################################################
 #
@@ -10,18 +385,24 @@ EMAIL_REGEX = r'(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)'
 #
 #######################################################################################################
 @safe_kwargs({
-    'message': {'required': True, 'doc': 'Message to be sent. Keys:', 'type': 'dict', 'schema': {
-        'email': {'required': True, 'type': 'string', 'regex': EMAIL_REGEX, 'doc': 'Receiver\'s e-mail address'},
-        'subject': {'required': True, 'type': 'string'},
-        'body': {'required': True, 'type': 'string'}}},
+    'message': {'required': True, 'doc': 'Message to be sent. Keys:', 'type': 'dict', 'schema': MESSAGE_SCHEMA},
     'host': {'required': True, 'type': 'string', 'doc': 'SMTP server\'s address'},
     'port': {'required': True, 'type': 'integer', 'doc': 'SMTP server\'s port'},
     'user': {'required': True, 'type': 'string', 'doc': 'SMTP server\'s username'},
-    'password': {'required': True, 'type': 'string', 'doc': 'SMTP server\'s password'}
-})
+    'password': {'required': True, 'type': 'string', 'doc': 'SMTP server\'s password'},
+    'outbox': {'type': 'boolean', 'doc': 'spool the message in the module-level outbox and return at once, the message being sent in the background. Defaults to False.'},
+    'attachments': {'type': 'list', 'doc': 'S3 files attached to the message. Keys:', 'schema': {'type': 'dict', 'schema': ATTACHMENT_SCHEMA}}
+}, engine='compiled')
 def send(**kwargs):
     """Send an e-mail message.
 
+    The SMTP connection is taken from smtp_pool and kept open for the next calls. With outbox, the
+    message is only written to the outbox spool (see Outbox) and send() does not wait for the server.
+
+    Attachments are streamed from S3 into the SMTP DATA command: a thread reads each file in chunks
+    and encodes them in base64 while the previous chunks are sent, up to ATTACHMENT_QUEUE_SIZE chunks
+    ahead, so the memory used does not depend on the size of the files.
+
     Args:
         **kwargs: keyword arguments. See below.
 
@@ -32,16 +413,21 @@ def send(**kwargs):
         ValueError: in case of missing or invalid kwargs.
 
     Returns:
-        The following dict for success: { 'status_code': 200 }
+        The following dict for success: { 'status_code': 200 }, or { 'status_code': 202, 'id': 1 } with
+        the spool id of the message with outbox.
     """    
     try:
         message = kwargs['message']
-        server = _open_server_connection(kwargs['host'], kwargs['port'], kwargs['user'], kwargs['password'])
+        if 'attachments' in kwargs:
+            message = dict(message, attachments=kwargs['attachments'])
 
-        mail = _build_message(message['subject'], message['body'])
-        server.sendmail(kwargs['user'], message['email'], mail.as_string())
+        if kwargs.get('outbox', False):
+            return {
+                'status_code': 202,
+                'id': outbox.enqueue(kwargs['host'], kwargs['port'], kwargs['user'], kwargs['password'], message)
+            }
 
-        server.close()      
+        _send_pooled(kwargs, lambda server: _send_message(server, kwargs['user'], message))
 
         return {
             'status_code': 200
@@ -50,11 +436,479 @@ def send(**kwargs):
     except Exception as e:
         raise e
 
+#######################################################################################################
+#
+#  send_many
+#
+#######################################################################################################
+@safe_kwargs({
+    'messages': {'required': True, 'type': 'list', 'schema': {'type': 'dict'}, 'doc': 'Messages to be sent, with the same keys as send\'s message.'},
+    'host': {'required': True, 'type': 'string', 'doc': 'SMTP server\'s address'},
+    'port': {'required': True, 'type': 'integer', 'doc': 'SMTP server\'s port'},
+    'user': {'required': True, 'type': 'string', 'doc': 'SMTP server\'s username'},
+    'password': {'required': True, 'type': 'string', 'doc': 'SMTP server\'s password'},
+    'max_connections': {'type': 'integer', 'doc': 'number of connections (and threads) sending at the same time. Defaults to 4.'},
+    'max_messages_per_connection': {'type': 'integer', 'doc': 'messages sent on a connection before it is replaced by a new one. Defaults to 100.'}
+}, engine='compiled')
+def send_many(**kwargs):
+    """Send many e-mail messages over a few long-lived connections.
+
+    Each worker thread holds one connection from smtp_pool and sends messages from the shared list
+    until it is empty, replacing its connection every max_messages_per_connection messages. A
+    message that is invalid or refused by the server does not stop the others.
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs.
+
+    Returns:
+        A list with the status of each message, in order: { 'status_code': 200 } for success, or
+        { 'status_code': 550, 'error': 'error message' } with the SMTP reply code (400 for an invalid
+        message, 503 for a message not sent because no connection could be opened).
+    """    
+    try:
+        import smtplib
+        credentials = (kwargs['host'], kwargs['port'], kwargs['user'], kwargs['password'])
+        messages = kwargs['messages']
+        max_messages = kwargs.get('max_messages_per_connection', 100)
+        statuses = [None] * len(messages)
+        pending = deque(enumerate(messages))
+        connection_errors = []
+
+        def worker():
+            connection = _PooledConnection(*credentials)
+            try:
+                while pending:
+                    try:
+                        index, message = pending.popleft()
+                    except IndexError:
+                        break
+
+                    errors = _message_errors(message)
+                    if errors:
+                        statuses[index] = {'status_code': 400, 'error': str(errors)}
+                        continue
+
+                    if connection.sent >= max_messages:
+                        connection.discard()
+
+                    try:
+                        connection.open()
+                    except Exception as e:
+                        # No connection could be opened: leave the remaining messages to the other workers.
+                        statuses[index] = {'status_code': 503, 'error': str(e)}
+                        connection_errors.append(e)
+                        return
+
+                    try:
+                        mail = _build_message(message['subject'], message['body']).as_string()
+                        connection.send(lambda server: server.sendmail(kwargs['user'], message['email'], mail))
+                        statuses[index] = {'status_code': 200}
+
+                    except smtplib.SMTPRecipientsRefused as e:
+                        code, response = next(iter(e.recipients.values()))
+                        statuses[index] = {'status_code': code, 'error': _decode_reply(response)}
+
+                    except smtplib.SMTPResponseException as e:
+                        # Refused sender or data: the message failed, the session is still usable.
+                        statuses[index] = {'status_code': e.smtp_code, 'error': _decode_reply(e.smtp_error)}
+
+                    except Exception as e:
+                        statuses[index] = {'status_code': 500, 'error': str(e)}
+            finally:
+                # Also reached when the worker fails unexpectedly, so the connection is never left checked out.
+                connection.release()
+
+        workers = [threading.Thread(target=worker) for i in range(max(1, min(kwargs.get('max_connections', 4), len(messages))))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        for index, status in enumerate(statuses):
+            if status is None:
+                error = connection_errors[-1] if connection_errors else 'no connection available'
+                statuses[index] = {'status_code': 503, 'error': f"not sent: {error}"}
+
+        return statuses
+
+    except Exception as e:
+        raise e
+
+#######################################################################################################
+#
+#  send_merge
+#
+#######################################################################################################
+@safe_kwargs({
+    'subject': {'required': True, 'type': 'string', 'doc': 'subject template (string.Template syntax).'},
+    'body': {'required': True, 'type': 'string', 'doc': 'body template (string.Template syntax).'},
+    'recipients': {'required': True, 'type': 'iterable', 'doc': 'recipient dicts (or a generator of them), with the e-mail address in \'email\' and the values of the placeholders.'},
+    'host': {'required': True, 'type': 'string', 'doc': 'SMTP server\'s address'},
+    'port': {'required': True, 'type': 'integer', 'doc': 'SMTP server\'s port'},
+    'user': {'required': True, 'type': 'string', 'doc': 'SMTP server\'s username'},
+    'password': {'required': True, 'type': 'string', 'doc': 'SMTP server\'s password'}
+}, engine='compiled')
+def send_merge(**kwargs):
+    """Send the same subject and body templates to many recipients, with per-recipient substitutions.
+
+    The templates are parsed once (see MailTemplate) and the recipients are consumed one at a time,
+    each message being rendered and sent before the next recipient is read, over one connection from
+    smtp_pool. A recipient that is invalid or refused by the server does not stop the others, but a
+    connection or login failure stops the merge: its error is reported for the recipient being sent
+    and the following recipients are not read.
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs.
+
+    Returns:
+        The number of messages sent and the errors by recipient index: { 'sent': 2, 'errors': { 1: 'error message' } }
+    """    
+    try:
+        import smtplib
+        credentials = (kwargs['host'], kwargs['port'], kwargs['user'], kwargs['password'])
+        template = MailTemplate(kwargs['subject'], kwargs['body'])
+        sent = 0
+        errors = {}
+        connection = _PooledConnection(*credentials)
+
+        try:
+            for index, recipient in enumerate(kwargs['recipients']):
+                address = recipient.get('email') if isinstance(recipient, Mapping) else None
+                if not isinstance(address, str) or EMAIL_PATTERN.match(address) is None:
+                    errors[index] = f"invalid recipient: {recipient!r}"
+                    continue
+                try:
+                    mail = template.render(recipient)
+                except ValueError as e:
+                    errors[index] = str(e)
+                    continue
+
+                try:
+                    connection.send(lambda server: server.sendmail(kwargs['user'], address, mail))
+                    sent += 1
+
+                except smtplib.SMTPRecipientsRefused as e:
+                    code, response = next(iter(e.recipients.values()))
+                    errors[index] = f"{code} {_decode_reply(response)}"
+
+                except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    errors[index] = f"{e.smtp_code} {_decode_reply(e.smtp_error)}"
+
+                except Exception as e:
+                    errors[index] = str(e)
+                    break
+
+        finally:
+            connection.release()
+
+        return {
+            'sent': sent,
+            'errors': errors
+        }
+
+    except Exception as e:
+        raise e
+
+#------------------------------------------------------------------------------------------------------
+#  _send_message
+#------------------------------------------------------------------------------------------------------
+def _send_message(server, sender, message):
+    if message.get('attachments'):
+        # The files are read from S3 while the envelope and the text are sent.
+        attachments = _Prefetch(_iter_attachments(message['attachments']), ATTACHMENT_QUEUE_SIZE)
+        try:
+            return _send_data(server, sender, message['email'], _iter_mixed_message(message['subject'], message['body'], attachments))
+        finally:
+            attachments.close()
+
+    return server.sendmail(sender, message['email'], _build_message(message['subject'], message['body']).as_string())
+
+#------------------------------------------------------------------------------------------------------
+#  _send_data
+#------------------------------------------------------------------------------------------------------
+def _send_data(server, sender, recipient, chunks):
+    # smtplib's sendmail() with a message sent chunk by chunk. The chunks are sent as they are: they
+    # must use CRLF line breaks, with dots already doubled.
+    import smtplib
+    server.ehlo_or_helo_if_needed()
+
+    code, response = server.mail(sender)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, response, sender)
+    code, response = server.rcpt(recipient)
+    if code not in (250, 251):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused({recipient: (code, response)})
+    code, response = server.docmd('data')
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, response)
+
+    try:
+        for chunk in chunks:
+            server.send(chunk)
+        server.send(b'.\r\n')
+    except BaseException:
+        # The message cannot be ended: closing the connection aborts it (QUIT would be read as data).
+        server.close()
+        raise
+
+    code, response = server.getreply()
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code, response)
+    return {}
+
+#------------------------------------------------------------------------------------------------------
+#  _iter_mixed_message
+#------------------------------------------------------------------------------------------------------
+def _iter_mixed_message(subject, body, attachments):
+    import smtplib
+    boundary = f"==============={uuid.uuid4().hex}=="
+    headers, content = _text_part(body)
+    text = ''.join((
+        _subject_header(subject), MIME_VERSION_HEADER, f'Content-Type: multipart/mixed;\n boundary="{boundary}"\n\n',
+        f"--{boundary}\n", headers, '\n', content))
+    yield smtplib.quotedata(text).encode('ascii')
+
+    # The line break before a boundary belongs to the boundary, not to the content of the part.
+    for chunk in attachments:
+        # Part headers are str, base64 lines bytes.
+        yield f"\r\n--{boundary}\r\n{chunk}".encode('ascii') if isinstance(chunk, str) else chunk
+    yield f"\r\n--{boundary}--\r\n".encode('ascii')
+
+#------------------------------------------------------------------------------------------------------
+#  _iter_attachments
+#------------------------------------------------------------------------------------------------------
+def _iter_attachments(attachments):
+    import mimetypes
+    from email.utils import encode_rfc2231
+    s3 = get_client('s3')
+
+    for attachment in attachments:
+        file_name = attachment.get('file_name') or attachment['file_key'].rsplit('/', 1)[-1]
+        content_type = attachment.get('content_type') or mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+        if file_name.isascii() and file_name.isprintable() and not any(character in file_name for character in '"\\'):
+            disposition = f'filename="{file_name}"'
+        else:
+            disposition = f"filename*={encode_rfc2231(file_name, 'utf-8')}"
+
+        obj = s3.get_object(Bucket=attachment['bucket_name'], Key=attachment['file_key'])
+        yield (f"Content-Type: {content_type}\r\nContent-Transfer-Encoding: base64\r\n"
+               f"Content-Disposition: attachment; {disposition}\r\n\r\n")
+        yield from _iter_base64(obj['Body'].iter_chunks(ATTACHMENT_CHUNK_SIZE))
+
+#------------------------------------------------------------------------------------------------------
+#  _iter_base64
+#------------------------------------------------------------------------------------------------------
+def _iter_base64(chunks):
+    pending = b''
+    for chunk in chunks:
+        data = pending + chunk if pending else chunk
+        # Only whole lines are encoded, the remaining bytes go with the next chunk.
+        cut = len(data) - len(data) % 57
+        pending = data[cut:]
+        if cut:
+            yield base64.encodebytes(memoryview(data)[:cut]).replace(b'\n', b'\r\n')
+    if pending:
+        yield base64.encodebytes(pending).replace(b'\n', b'\r\n')
+
+#------------------------------------------------------------------------------------------------------
+#  _Prefetch
+#------------------------------------------------------------------------------------------------------
+class _Prefetch:
+    # Iterator over items read by a thread, started at once and at most max_size items ahead of the
+    # consumer. close() stops the thread.
+    def __init__(self, items, max_size):
+        self._queue = Queue(max_size)
+        self._stopped = threading.Event()
+        self._done = False
+        threading.Thread(target=self._produce, args=(items,), daemon=True).start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        item, error = self._queue.get()
+        if error is not None:
+            self._done = True
+            raise error
+        return item
+
+    def close(self):
+        self._stopped.set()
+
+    def _produce(self, items):
+        try:
+            for item in items:
+                if not self._put((item, None)):
+                    return
+            self._put((None, StopIteration()))
+        except Exception as e:
+            self._put((None, e))
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+#------------------------------------------------------------------------------------------------------
+#  _message_errors
+#------------------------------------------------------------------------------------------------------
+def _message_errors(message):
+    try:
+        _check_message(**message)
+        return None
+    except ValueError as e:
+        return e.args[0]
+    except Exception as e:
+        # e.g. TypeError for keys that are not strings.
+        return str(e)
+
+#------------------------------------------------------------------------------------------------------
+#  _check_message
+#------------------------------------------------------------------------------------------------------
+@safe_kwargs(MESSAGE_SCHEMA, engine='compiled')
+def _check_message(**kwargs):
+    return kwargs
+
+#------------------------------------------------------------------------------------------------------
+#  _decode_reply
+#------------------------------------------------------------------------------------------------------
+def _decode_reply(reply):
+    return reply.decode('utf-8', errors='replace') if isinstance(reply, bytes) else str(reply)
+
+#------------------------------------------------------------------------------------------------------
+#  _send_pooled
+#------------------------------------------------------------------------------------------------------
+def _send_pooled(kwargs, send_with):
+    connection = _PooledConnection(kwargs['host'], kwargs['port'], kwargs['user'], kwargs['password'])
+    try:
+        return connection.send(send_with)
+    finally:
+        connection.release()
+
+#------------------------------------------------------------------------------------------------------
+#  _PooledConnection
+#------------------------------------------------------------------------------------------------------
+class _PooledConnection:
+    # Connection from smtp_pool held for one or more messages, with the retry and discard rules shared
+    # by every sender. send() reconnects and sends again once when the server has closed the connection
+    # since the last check. A message refused by the server leaves the session usable; any other error
+    # discards the connection, and the next send() takes a new one from the pool.
+    def __init__(self, host, port, user, password):
+        self.credentials = (host, port, user, password)
+        self.server = None
+        self.sent = 0
+
+    def open(self):
+        if self.server is None:
+            self.server, self.sent = smtp_pool.acquire(*self.credentials), 0
+        return self.server
+
+    def send(self, send_with):
+        import smtplib
+        self.open()
+        try:
+            try:
+                result = send_with(self.server)
+            except smtplib.SMTPServerDisconnected:
+                self.discard()
+                self.server, self.sent = smtp_pool.connect(*self.credentials), 0
+                result = send_with(self.server)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            self.sent += 1
+            raise
+        except Exception:
+            self.discard()
+            raise
+        self.sent += 1
+        return result
+
+    def release(self):
+        if self.server is not None:
+            smtp_pool.release(*self.credentials, self.server)
+            self.server = None
+
+    def discard(self):
+        if self.server is not None:
+            smtp_pool.discard(self.server)
+            self.server = None
+
+#------------------------------------------------------------------------------------------------------
+#  _is_alive
+#------------------------------------------------------------------------------------------------------
+def _is_alive(server):
+    import smtplib
+    try:
+        return server.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+#------------------------------------------------------------------------------------------------------
+#  _subject_header
+#------------------------------------------------------------------------------------------------------
+def _subject_header(subject):
+    if subject.isascii() and subject.isprintable() and len(subject) <= 69:
+        return 'Subject: ' + subject + '\n'
+    return _fold_subject(subject)
+
+#------------------------------------------------------------------------------------------------------
+#  _text_part
+#------------------------------------------------------------------------------------------------------
+def _text_part(body):
+    # Line breaks are normalized to '\n', as by EmailMessage.set_content().
+    if '\r' in body:
+        body = body.replace('\r\n', '\n').replace('\r', '\n')
+    if not body.endswith('\n'):
+        body += '\n'
+
+    if body.isascii() and LONG_LINE_REGEX.search(body) is None:
+        return TEXT_7BIT_HEADERS, body
+    return TEXT_BASE64_HEADERS, base64.encodebytes(body.encode('utf-8')).decode('ascii')
+
+#------------------------------------------------------------------------------------------------------
+#  _fold_subject
+#------------------------------------------------------------------------------------------------------
+def _fold_subject(subject):
+    from email.message import EmailMessage
+    msg = EmailMessage()
+
+    # Raises ValueError for line breaks, like _build_message().
+    msg['Subject'] = subject
+    return msg.policy.fold('Subject', msg['Subject'])
+
+#------------------------------------------------------------------------------------------------------
+#  _password_digest
+#------------------------------------------------------------------------------------------------------
+def _password_digest(password):
+    return hashlib.sha256(password.encode('utf-8')).digest()
+
 #------------------------------------------------------------------------------------------------------
 #  _build_message
 #------------------------------------------------------------------------------------------------------
 def _build_message(subject, body):
     try:
+        from email.message import EmailMessage
         msg = EmailMessage()
 
         msg['Subject'] = subject
@@ -69,7 +923,8 @@ def _build_message(subject, body):
 #  _open_server_connection
 #------------------------------------------------------------------------------------------------------
 def _open_server_connection(host, port, user, password):
-    try:   
+    try:
+        import smtplib
         server = smtplib.SMTP_SSL(host, port)
 
         server.ehlo()
@@ -1,11 +1,53 @@
-import boto3
+import codecs
+import hashlib
 import json
 import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain
 from string import Template
+from .cache import LRUCache, freeze
+from .clients import get_client
 from .safe_kwargs import safe_kwargs
+from .template import CompiledTemplate, compile_template, template_cache
 
 PATH_REGEX = r'^[a-zA-Z0-9_/-]*[^/]$'
-FILE_KEY_REGEX = r'^([a-zA-Z0-9_-]+[a-zA-Z0-9_-]*/)*([a-zA-Z0-9_-]*\.[a-zA-Z0-9_]+)$'
+FILE_KEY_REGEX = r'^([a-zA-Z0-9_-]+[a-zA-Z0-9_-]*/)*([a-zA-Z0-9_-]*(\.[a-zA-Z0-9_]+)+)$'
+
+# Size of the reads of the streaming readers (iter_json_array, iter_json_lines, populate_template).
+STREAM_CHUNK_SIZE = 64 * 1024
+# Transfer engine settings, see configure_transfers.
+DEFAULT_TRANSFER_CONFIG = {
+    'threshold': 16 * 1024 * 1024,
+    'part_size': 8 * 1024 * 1024,
+    'max_concurrency': 10,
+    'max_attempts': 3
+}
+# S3 limits of multipart uploads.
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+# Compression codecs, detected on read from ContentEncoding, then file extension, then magic bytes.
+CODECS = {
+    'gzip': {'encodings': ('gzip', 'x-gzip'), 'extension': '.gz', 'magic': re.compile(b'\x1f\x8b')},
+    'bzip2': {'encodings': ('bzip2', 'x-bzip2'), 'extension': '.bz2', 'magic': re.compile(b'BZh[1-9](1AY&SY|\x17rE8P\x90)')},
+    'xz': {'encodings': ('xz', 'x-xz'), 'extension': '.xz', 'magic': re.compile(b'\xfd7zXZ\x00')}
+}
+# Trailing '$...' that may be the beginning of a placeholder continued in the next chunk.
+INCOMPLETE_PLACEHOLDER_REGEX = re.compile(r'\$(\{?[_a-z][_a-z0-9]*|\{)?', re.IGNORECASE | re.ASCII)
+# Trailing characters that may continue a json number cut by the end of a chunk (e.g. '1.' or '1.5e-').
+NUMBER_TAIL_REGEX = re.compile(r'[0-9.eE+-]*')
+
+# Listings cached by list_files when cache_ttl is given, keyed by (bucket_name, path).
+listing_cache = LRUCache(max_entries=256)
+
+# Documents cached by read_json_file when cache is True, keyed by (bucket_name, file_key) and bounded
+# by the size of the downloaded files.
+json_cache = LRUCache(max_entries=64, max_bytes=64 * 1024 * 1024)
+
+_transfer_config = dict(DEFAULT_TRANSFER_CONFIG)
 
 #######################################################################################################
 #
@@ -14,11 +56,17 @@ FILE_KEY_REGEX = r'^([a-zA-Z0-9_-]+[a-zA-Z0-9_-]*/)*([a-zA-Z0-9_-]*\.[a-zA-Z0-9_
 #######################################################################################################
 @safe_kwargs({
     'bucket_name': {'required': True, 'type': 'string', 'doc': 'S3 bucket name'},
-    'path': {'required': True, 'type': 'string', 'regex': PATH_REGEX, 'doc': 'the path to be listed on S3 bucket'}
-})
+    'path': {'required': True, 'type': 'string', 'regex': PATH_REGEX, 'doc': 'the path to be listed on S3 bucket'},
+    'cache_ttl': {'type': 'number', 'doc': 'enables the listing cache: for cache_ttl seconds after a full listing, only keys after the last cached one are listed.'},
+    'full_refresh': {'type': 'boolean', 'doc': 'with cache_ttl, list the whole path again instead of refreshing incrementally.'}
+}, engine='compiled')
 def list_files(**kwargs):
     """List files keys based on a S3 path.
 
+    With cache_ttl, the listing is cached and refreshed with StartAfter, which is meant for
+    append-only paths: files deleted, or added before the last cached key, show up only after the
+    next full listing.
+
     Args:
         **kwargs: keyword arguments. See below.
 
@@ -32,29 +80,222 @@ def list_files(**kwargs):
         A list of dict of file keys: { 'file_name': 'path/to/file' }
     """    
     try:
-        s3 = boto3.client('s3')
-        files = []
-        path = kwargs['path'] + '/'
-        path_depth = len(path.split('/'))
+        s3 = get_client('s3')
+        if 'cache_ttl' in kwargs:
+            files = _cached_keys(s3, kwargs['bucket_name'], kwargs['path'] + '/', kwargs['cache_ttl'], kwargs.get('full_refresh', False))
+        else:
+            files = list(_iter_keys(s3, kwargs['bucket_name'], kwargs['path'] + '/'))
+            files.sort()
+
+        return [ { 'file_name': file } for file in files ]
+
+    except Exception as e:
+        raise e
 
-        response = s3.list_objects_v2(Bucket=kwargs['bucket_name'], Prefix=path)
+#######################################################################################################
+#
+#  iter_files
+#
+#######################################################################################################
+@safe_kwargs({
+    'bucket_name': {'required': True, 'type': 'string', 'doc': 'S3 bucket name'},
+    'path': {'required': True, 'type': 'string', 'regex': PATH_REGEX, 'doc': 'the path to be listed on S3 bucket'}
+}, engine='compiled')
+def iter_files(**kwargs):
+    """Iterate over the files keys directly under a S3 path, one listing page at a time.
 
-        for content in response['Contents']:
-            content_depth = len(content['Key'].split('/'))
-            if content_depth - path_depth > 0: continue
-            
-            file_name = os.path.basename(content['Key'])
-            if not file_name: continue
-            
-            files.append(content['Key'])
+    Only the direct children of the path are listed: deeper keys are grouped by S3 (Delimiter='/')
+    instead of being downloaded and discarded.
 
-        files.sort()
+    Args:
+        **kwargs: keyword arguments. See below.
 
-        return [ { 'file_name': file } for file in files ]
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs.
+
+    Yields:
+        A dict per file key, in S3 order: { 'file_name': 'path/to/file' }
+    """    
+    try:
+        s3 = get_client('s3')
+
+        for key in _iter_keys(s3, kwargs['bucket_name'], kwargs['path'] + '/'):
+            yield { 'file_name': key }
+
+    except Exception as e:
+        raise e
+
+#------------------------------------------------------------------------------------------------------
+#  _iter_keys
+#------------------------------------------------------------------------------------------------------
+def _iter_keys(s3, bucket_name, prefix, start_after=None):
+    for response in _iter_pages(s3, bucket_name, prefix, start_after):
+        for content in response.get('Contents', []):
+            if os.path.basename(content['Key']):
+                yield content['Key']
+
+#------------------------------------------------------------------------------------------------------
+#  _iter_pages
+#------------------------------------------------------------------------------------------------------
+def _iter_pages(s3, bucket_name, prefix, start_after=None):
+    params = {'Bucket': bucket_name, 'Prefix': prefix, 'Delimiter': '/'}
+    if start_after:
+        params['StartAfter'] = start_after
+
+    while True:
+        response = s3.list_objects_v2(**params)
+        yield response
+
+        if not response.get('IsTruncated'):
+            return
+        params['ContinuationToken'] = response['NextContinuationToken']
+
+#------------------------------------------------------------------------------------------------------
+#  _cached_keys
+#------------------------------------------------------------------------------------------------------
+def _cached_keys(s3, bucket_name, prefix, ttl, full_refresh):
+    cache_key = (bucket_name, prefix)
+    cached = None if full_refresh else listing_cache.get(cache_key)
+    now = time.monotonic()
+
+    if cached is None or now - cached['listed_at'] > ttl:
+        cached = {'keys': sorted(_iter_keys(s3, bucket_name, prefix)), 'listed_at': now}
+    else:
+        # S3 lists keys in lexical order, so new keys of an append-only path come after the last one.
+        last_key = cached['keys'][-1] if cached['keys'] else None
+        new_keys = list(_iter_keys(s3, bucket_name, prefix, start_after=last_key))
+        if new_keys:
+            cached = {'keys': cached['keys'] + new_keys, 'listed_at': cached['listed_at']}
+
+    listing_cache.put(cache_key, cached)
+    return cached['keys']
+
+#######################################################################################################
+#
+#  walk_files
+#
+#######################################################################################################
+@safe_kwargs({
+    'bucket_name': {'required': True, 'type': 'string', 'doc': 'S3 bucket name'},
+    'path': {'required': True, 'type': 'string', 'regex': PATH_REGEX, 'doc': 'the path to be listed on S3 bucket'},
+    'max_workers': {'type': 'integer', 'doc': 'maximum number of sub-paths listed concurrently. Defaults to 16.'},
+    'ordered': {'type': 'boolean', 'doc': 'yield the keys in S3 (lexical) order instead of as soon as they are listed.'}
+}, engine='compiled')
+def walk_files(**kwargs):
+    """Iterate over all the files keys under a S3 path, recursively.
+
+    Each sub-path (S3 common prefix) is listed as a separate task on a bounded thread pool, so the
+    wall time follows the depth of the tree rather than the number of keys. At most twice max_workers
+    listings are submitted ahead of the consumer, so a slow consumer does not let the whole tree pile
+    up in memory.
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs.
+
+    Yields:
+        A dict per file key: { 'file_name': 'path/to/file' }
+    """    
+    s3 = get_client('s3')
+    stop = threading.Event()
+    max_workers = kwargs.get('max_workers', 16)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def list_prefix(prefix):
+        if stop.is_set():
+            return [], []
+        return _list_prefix(s3, kwargs['bucket_name'], prefix)
+
+    try:
+        submit = lambda prefix: executor.submit(list_prefix, prefix)
+        walk = _walk_ordered if kwargs.get('ordered', False) else _walk_completed
+        keys = walk(submit, kwargs['path'] + '/', 2 * max_workers)
+
+        for key in keys:
+            yield { 'file_name': key }
 
     except Exception as e:
         raise e
 
+    finally:
+        # Tasks still queued return at once, so closing the generator early stops the walk.
+        stop.set()
+        executor.shutdown(wait=True)
+
+#------------------------------------------------------------------------------------------------------
+#  _list_prefix
+#------------------------------------------------------------------------------------------------------
+def _list_prefix(s3, bucket_name, prefix):
+    keys = []
+    prefixes = []
+
+    for response in _iter_pages(s3, bucket_name, prefix):
+        keys += [content['Key'] for content in response.get('Contents', []) if os.path.basename(content['Key'])]
+        prefixes += [common_prefix['Prefix'] for common_prefix in response.get('CommonPrefixes', [])]
+
+    return keys, prefixes
+
+#------------------------------------------------------------------------------------------------------
+#  _walk_completed
+#------------------------------------------------------------------------------------------------------
+def _walk_completed(submit, root, max_pending):
+    # Sub-paths found by a listing are only submitted once its keys have been consumed.
+    prefixes = deque([root])
+    pending = set()
+
+    while prefixes or pending:
+        while prefixes and len(pending) < max_pending:
+            pending.add(submit(prefixes.popleft()))
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            keys, children = future.result()
+            prefixes.extend(children)
+            yield from keys
+
+#------------------------------------------------------------------------------------------------------
+#  _walk_ordered
+#------------------------------------------------------------------------------------------------------
+def _walk_ordered(submit, root, max_pending):
+    # Depth-first walk: keys under a common prefix sort right where the prefix itself sorts among
+    # its siblings. Each frame of the stack is a listed prefix; the next sub-paths in walk order (of
+    # the deepest frames first) are submitted ahead, up to max_pending unconsumed listings.
+    futures = {root: submit(root)}
+    stack = []
+
+    def push(prefix):
+        keys, prefixes = futures.pop(prefix).result()
+        entries = sorted([(key, False) for key in keys] + [(child, True) for child in prefixes])
+        stack.append({'entries': iter(entries), 'prefixes': sorted(prefixes), 'submitted': 0})
+
+    push(root)
+    while stack:
+        for frame in reversed(stack):
+            while len(futures) < max_pending and frame['submitted'] < len(frame['prefixes']):
+                futures[frame['prefixes'][frame['submitted']]] = submit(frame['prefixes'][frame['submitted']])
+                frame['submitted'] += 1
+            if len(futures) >= max_pending:
+                break
+
+        entry = next(stack[-1]['entries'], None)
+        if entry is None:
+            stack.pop()
+        elif not entry[1]:
+            yield entry[0]
+        else:
+            if entry[0] not in futures:
+                # Not submitted ahead: prefixes are submitted and reached in the same order.
+                futures[entry[0]] = submit(entry[0])
+                stack[-1]['submitted'] += 1
+            push(entry[0])
+
 #######################################################################################################
 #
 #  populate_template
@@ -68,11 +309,28 @@ def list_files(**kwargs):
     'output_type': {'required': True, 'type': 'string', 'doc': '\'text\' or \'file\'. \'file\' requires output_file or output_path.', 'oneof': [{'allowed': ['text']}, {'allowed': ['file'], 'dependencies': 'output_file'}, {'allowed': ['file'], 'dependencies': 'output_path'}]},
     'output_file': {'type': 'string', 'regex': FILE_KEY_REGEX, 'doc': 'file to be saved on S3 bucket.', 'dependencies': 'bucket_name', 'excludes': 'output_path'},
     'output_path': {'type': 'string', 'regex': PATH_REGEX, 'doc': 'path of file to be saved on S3 bucket.', 'dependencies': 'bucket_name', 'excludes': 'output_file'},
-    'bucket_name': {'type': 'string', 'doc': 'required if input_type==\'file\' or output_type==\'file\'.'}
-})
+    'bucket_name': {'type': 'string', 'doc': 'required if input_type==\'file\' or output_type==\'file\'.'},
+    'cache_ttl': {'type': 'number', 'doc': 'for cache_ttl seconds after input_file is downloaded or revalidated, its cached template is used without checking its ETag.'},
+    'stream': {'type': 'boolean', 'doc': 'read input_file and write the output in chunks, with constant memory whatever the file size. Requires input_type==\'file\' and output_type==\'file\'.', 'dependencies': {'input_type': ['file'], 'output_type': ['file']}},
+    'skip_unchanged': {'type': 'boolean', 'doc': 'do not save the output when the existing output file has the same content (same MD5 ETag). Requires output_type==\'file\'.', 'dependencies': {'output_type': ['file']}},
+    'compression': {'type': 'string', 'allowed': list(CODECS), 'doc': 'compress the output file and set its ContentEncoding. Requires output_type==\'file\'.', 'dependencies': {'output_type': ['file']}}
+}, engine='compiled')
 def populate_template(**kwargs):
     """Substitute the placeholders on a template text.
 
+    Templates are parsed once and kept in template.template_cache: input_text by content hash and
+    input_file by key, revalidated with its ETag on each call (see cache_ttl). A compressed
+    input_file is decompressed (see CODECS).
+
+    With stream, the template is not cached: input_file is read in chunks and the output is written
+    through a multipart upload started as soon as the output reaches part_size (see
+    configure_transfers), so memory holds at most one part plus one read chunk.
+
+    With skip_unchanged, the ETag of the output file (HEAD request) is compared with the MD5 of the
+    output, in its single part or multipart form, and the output is only saved when they differ. It
+    is also saved when the HEAD request is denied (403).
+    Objects encrypted with SSE-KMS have no MD5 ETag and are always saved.
+
     Args:
         **kwargs: keyword arguments. See below.
 
@@ -84,36 +342,337 @@ def populate_template(**kwargs):
 
     Returns:
         Populated text: when output_type == 'text'. Or:
-        File key: when output_type == 'file'.
+        File key: when output_type == 'file'. Or:
+        A dict { 'output_file': 'file key', 'written': True }: with skip_unchanged.
     """    
     try:
-        s3 = boto3.resource('s3')
+        s3 = get_client('s3')
 
-        input = ''
-        if kwargs['input_type'] == 'file':
-            obj = s3.Object(kwargs['bucket_name'], kwargs['input_file'])
-            input = obj.get()['Body'].read().decode('utf-8')
+        if kwargs.get('stream', False):
+            output_file, written = _stream_template(s3, kwargs)
         else:
-            input = kwargs['input_text']
+            template = _get_template(s3, kwargs)
+            output = template.substitute(kwargs['substitutions'])
+
+            if kwargs['output_type'] == 'text':
+                return output
+
+            if template.text == output:
+                output_file, written = kwargs['input_file'], False
+            else:
+                output_file = _output_file(kwargs)
+                body = _compress(output.encode('utf-8'), kwargs.get('compression'))
+                written = True
+                if kwargs.get('skip_unchanged', False):
+                    content_hash = _ContentHash()
+                    content_hash.update(body)
+                    written = _head_etag(s3, kwargs['bucket_name'], output_file) not in content_hash.etags()
+                if written:
+                    _put_object(s3, kwargs['bucket_name'], output_file, body, **_encoding_params(kwargs.get('compression')))
+
+        if kwargs.get('skip_unchanged', False):
+            return { 'output_file': output_file, 'written': written }
+        return output_file
+
+    except Exception as e:
+        raise e
+
+#------------------------------------------------------------------------------------------------------
+#  _output_file
+#------------------------------------------------------------------------------------------------------
+def _output_file(kwargs):
+    output_file = kwargs.get('output_file', '')
+    if not output_file:
+        output_file = kwargs['output_path'] + '/' + os.path.basename(kwargs['input_file'])
+    return output_file
 
-        output = Template(input).safe_substitute(**kwargs['substitutions'])
+#------------------------------------------------------------------------------------------------------
+#  _stream_template
+#------------------------------------------------------------------------------------------------------
+def _stream_template(s3, kwargs):
+    output_file = _output_file(kwargs)
+    obj = s3.get_object(Bucket=kwargs['bucket_name'], Key=kwargs['input_file'])
+    body = obj['Body']
+    writer = _MultipartWriter(s3, kwargs['bucket_name'], output_file, kwargs.get('compression'))
+    changed = False
 
-        if kwargs['output_type'] == 'text':
-            return output
+    try:
+        for input, output in _stream_substitute(_iter_body(obj, kwargs['input_file']), kwargs['substitutions']):
+            changed = changed or input != output
+            writer.write(output.encode('utf-8'))
+
+        if not changed:
+            writer.abort()
+            return kwargs['input_file'], False
+
+        writer.flush()
+        if kwargs.get('skip_unchanged', False) and _head_etag(s3, kwargs['bucket_name'], output_file) in writer.hash.etags():
+            writer.abort()
+            return output_file, False
+
+        writer.close()
+        return output_file, True
+
+    except Exception:
+        writer.abort()
+        raise
+
+    finally:
+        body.close()
+
+#------------------------------------------------------------------------------------------------------
+#  _stream_substitute
+#------------------------------------------------------------------------------------------------------
+def _stream_substitute(chunks, substitutions):
+    # Yields (input, output) text pairs. A trailing '$', '$name', '${' or '${name' is held back and
+    # prepended to the next chunk, as the placeholder may go on there.
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    tail = ''
+
+    for chunk in chunks:
+        text = tail + text_decoder.decode(chunk)
+        cut = _placeholder_cut(text)
+        tail = text[cut:]
+        if cut:
+            yield text[:cut], Template(text[:cut]).safe_substitute(substitutions)
+
+    text = tail + text_decoder.decode(b'', final=True)
+    if text:
+        yield text, Template(text).safe_substitute(substitutions)
+
+#------------------------------------------------------------------------------------------------------
+#  _placeholder_cut
+#------------------------------------------------------------------------------------------------------
+def _placeholder_cut(text):
+    start = text.rfind('$')
+    if start < 0 or not INCOMPLETE_PLACEHOLDER_REGEX.fullmatch(text, start):
+        return len(text)
+
+    # In a run of '$', pairs are '$$' escapes: the last one starts a placeholder only if the run is odd.
+    run_start = start
+    while run_start > 0 and text[run_start - 1] == '$':
+        run_start -= 1
+
+    return start if (start - run_start) % 2 == 0 else len(text)
+
+#------------------------------------------------------------------------------------------------------
+#  _MultipartWriter
+#------------------------------------------------------------------------------------------------------
+class _MultipartWriter:
+    # Buffers writes into parts of the configured part_size. The multipart upload is created when the
+    # first part is full, and an output smaller than one part is saved with a single put_object, so
+    # at most one part is held in memory.
+    def __init__(self, s3, bucket_name, file_key, compression=None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.params = _encoding_params(compression)
+        self.compressor = _compressor(compression) if compression else None
+        self.config = dict(_transfer_config)
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+        self.hash = _ContentHash(self.config['part_size'])
+
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self._write(data)
+
+    def flush(self):
+        # Ends the compressed stream: no more write() once flushed.
+        if self.compressor is not None:
+            self._write(self.compressor.flush())
+            self.compressor = None
+
+    def _write(self, data):
+        self.hash.update(data)
+        view = memoryview(data)
+        while len(self.buffer) + len(view) >= self.config['part_size']:
+            cut = self.config['part_size'] - len(self.buffer)
+            self.buffer += view[:cut]
+            view = view[cut:]
+            self._upload_part()
+        self.buffer += view
+
+    def close(self):
+        self.flush()
+        if self.upload_id is None:
+            _put_object(self.s3, self.bucket_name, self.file_key, self.buffer, **self.params)
         else:
-            if input == output:
+            if self.buffer:
+                self._upload_part()
+            self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=self.file_key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.file_key, UploadId=self.upload_id)
+            self.upload_id = None
+        self.buffer = bytearray()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=self.file_key, **self.params)['UploadId']
+
+        # Parts have exactly part_size bytes, except the last one, so the ETag of the object can be
+        # computed again from its content (see _ContentHash). The buffer is handed over, not copied.
+        data, self.buffer = self.buffer, bytearray()
+        part_number = len(self.parts) + 1
+        self.parts.append(_upload_part(self.s3, self.bucket_name, self.file_key, self.upload_id, part_number,
+                                       data, self.config['max_attempts']))
+
+#------------------------------------------------------------------------------------------------------
+#  _ContentHash
+#------------------------------------------------------------------------------------------------------
+class _ContentHash:
+    # MD5 of a content and of each of its parts, to compare it with the ETag of an object saved
+    # either with put_object or with a multipart upload of the same part size.
+    def __init__(self, part_size=None):
+        self.part_size = part_size or _transfer_config['part_size']
+        self.md5 = hashlib.md5()
+        self.part_md5 = hashlib.md5()
+        self.part_length = 0
+        self.part_digests = []
+
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            piece = data[:self.part_size - self.part_length]
+            self.md5.update(piece)
+            self.part_md5.update(piece)
+            self.part_length += len(piece)
+            data = data[len(piece):]
+
+            if self.part_length == self.part_size:
+                self.part_digests.append(self.part_md5.digest())
+                self.part_md5 = hashlib.md5()
+                self.part_length = 0
+
+    def etags(self):
+        digests = self.part_digests + ([self.part_md5.digest()] if self.part_length or not self.part_digests else [])
+        return {
+            f'"{self.md5.hexdigest()}"',
+            f'"{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}"'
+        }
+
+#------------------------------------------------------------------------------------------------------
+#  _head_etag
+#------------------------------------------------------------------------------------------------------
+def _head_etag(s3, bucket_name, file_key):
+    # None when the ETag is unknown, so the output is written. Without s3:ListBucket permission, S3
+    # answers 403 instead of 404 for a missing key: it is handled the same way.
+    try:
+        return s3.head_object(Bucket=bucket_name, Key=file_key)['ETag']
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('403', 'AccessDenied', 'Forbidden', '404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+#######################################################################################################
+#
+#  populate_templates
+#
+#######################################################################################################
+@safe_kwargs({
+    'input_type': {'required': True, 'type': 'string', 'allowed': ['file', 'text'], 'doc': '\'text\' or \'file\'.'},
+    'input_file': {'required': True, 'type': 'string', 'doc': 'input file key on S3 bucket. Required only if input_type==\'file\'.', 'regex': FILE_KEY_REGEX, 'dependencies': {'input_type': 'file'}, 'excludes': 'input_text'},
+    'input_text': {'required': True, 'type': 'string', 'doc': 'template text to be populated. Required only if input_type==\'text\'.', 'dependencies': {'input_type': 'text'}, 'excludes': 'input_file'},
+    'items': {'required': True, 'type': 'iterable', 'doc': '(substitutions, output_file) pairs: substitutions is a dict of key/value pairs for template placeholders, output_file the file to be saved on S3 bucket. Can be a generator.'},
+    'bucket_name': {'required': True, 'type': 'string', 'doc': 'S3 bucket name.'},
+    'max_concurrency': {'type': 'integer', 'min': 1, 'doc': 'maximum number of files rendered and uploaded at the same time. Defaults to 16.'},
+    'cache_ttl': {'type': 'number', 'doc': 'same as populate_template.'},
+    'compression': {'type': 'string', 'allowed': list(CODECS), 'doc': 'same as populate_template.'}
+}, engine='compiled')
+def populate_templates(**kwargs):
+    """Substitute the placeholders on one template with many substitution sets, saving each output on S3.
+
+    The template is read and parsed once. Outputs are rendered and uploaded on a thread pool, and
+    items are taken from the iterable only as workers become free, so at most twice max_concurrency
+    outputs are held in memory. A failing item (invalid item, upload error...) does not stop the
+    others: its error is returned instead.
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs.
+
+    Returns:
+        A dict { 'output_files': ['file key', None, ...], 'errors': { index: 'error message' } }, where
+        output_files follows the order of items (None for a failed item) and errors is keyed by item
+        index. As for populate_template, an output identical to input_file is not saved and its key is
+        input_file.
+    """    
+    try:
+        s3 = get_client('s3')
+        template = _get_template(s3, kwargs)
+        text = template.text
+        max_concurrency = kwargs.get('max_concurrency', 16)
+        output_files = []
+        errors = {}
+
+        def populate(item):
+            substitutions, output_file = _check_template_item(item)
+            output = template.substitute(substitutions)
+            if kwargs['input_type'] == 'file' and output == text:
                 return kwargs['input_file']
-            else:
-                output_file = kwargs.get('output_file', '')
-                if not output_file:
-                    output_file = kwargs['output_path'] + '/' + os.path.basename(kwargs['input_file'])
-                obj = s3.Object(kwargs['bucket_name'], output_file)
-                obj.put(Body=output)
-                return output_file
+            _put_object(s3, kwargs['bucket_name'], output_file, _compress(output.encode('utf-8'), kwargs.get('compression')),
+                        **_encoding_params(kwargs.get('compression')))
+            return output_file
+
+        def collect(futures):
+            for future in futures:
+                index = pending.pop(future)
+                try:
+                    output_files[index] = future.result()
+                except Exception as e:
+                    errors[index] = str(e)
+
+        pending = {}
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            for index, item in enumerate(kwargs['items']):
+                if len(pending) >= 2 * max_concurrency:
+                    collect(wait(pending, return_when=FIRST_COMPLETED)[0])
+                output_files.append(None)
+                pending[executor.submit(populate, item)] = index
+            collect(list(pending))
+
+        return { 'output_files': output_files, 'errors': errors }
 
     except Exception as e:
         raise e
 
+#------------------------------------------------------------------------------------------------------
+#  _get_template
+#------------------------------------------------------------------------------------------------------
+def _get_template(s3, kwargs):
+    if kwargs['input_type'] == 'file':
+        return _cached_object(template_cache, ('s3', kwargs['bucket_name'], kwargs['input_file']), s3,
+                              kwargs['bucket_name'], kwargs['input_file'], kwargs.get('cache_ttl'),
+                              lambda body: CompiledTemplate(body.decode('utf-8')))
+
+    return compile_template(kwargs['input_text'])
+
+#------------------------------------------------------------------------------------------------------
+#  _check_template_item
+#------------------------------------------------------------------------------------------------------
+def _check_template_item(item):
+    if not isinstance(item, (list, tuple)) or len(item) != 2:
+        raise ValueError('item must be a (substitutions, output_file) pair')
+
+    substitutions, output_file = item
+    if not isinstance(substitutions, dict) or not all(isinstance(key, str) and isinstance(value, str) for key, value in substitutions.items()):
+        raise ValueError('substitutions must be a dict of strings')
+    if not isinstance(output_file, str) or not re.match(FILE_KEY_REGEX, output_file):
+        raise ValueError(f"output_file value does not match regex '{FILE_KEY_REGEX}'")
+
+    return substitutions, output_file
+
 #######################################################################################################
 #
 #  read_json_file
@@ -121,10 +680,15 @@ def populate_template(**kwargs):
 #######################################################################################################
 @safe_kwargs({
     'bucket_name': {'required': True, 'type': 'string', 'doc': 'S3 bucket name.'},
-    'file_key': {'required': True, 'type': 'string', 'regex': FILE_KEY_REGEX, 'doc': 'file key on S3 bucket.'}
-})
+    'file_key': {'required': True, 'type': 'string', 'regex': FILE_KEY_REGEX, 'doc': 'file key on S3 bucket.'},
+    'cache': {'type': 'boolean', 'doc': 'keep the decoded file in memory and only download it again when its ETag changes. The returned value is read-only.'},
+    'cache_ttl': {'type': 'number', 'doc': 'implies cache: for cache_ttl seconds after a download or a revalidation, the cached value is returned without checking its ETag.'}
+}, engine='compiled')
 def read_json_file(**kwargs):
-    """Read content of S3 file as json.
+    """Read content of S3 file as json. A compressed file is decompressed (see CODECS).
+
+    With cache (or cache_ttl), the value is returned read-only (dicts and lists are FrozenDict and
+    FrozenList), as it is shared with the next calls: use copy.deepcopy() to get a mutable copy.
 
     Args:
         **kwargs: keyword arguments. See below.
@@ -139,11 +703,584 @@ def read_json_file(**kwargs):
         Text decoded as json.
     """    
     try:
-        s3 = boto3.resource('s3')
-        obj = s3.Object(kwargs['bucket_name'], kwargs['file_key'])
-        body = obj.get()['Body'].read().decode('utf-8')      
-        
-        return json.loads(body)
+        s3 = get_client('s3')
+
+        cache = kwargs.get('cache', False) or 'cache_ttl' in kwargs
+
+        return _read_json(s3, kwargs['bucket_name'], kwargs['file_key'], cache, kwargs.get('cache_ttl'))
+
+    except Exception as e:
+        raise e
+
+#######################################################################################################
+#
+#  read_json_files
+#
+#######################################################################################################
+@safe_kwargs({
+    'bucket_name': {'required': True, 'type': 'string', 'doc': 'S3 bucket name.'},
+    'file_keys': {'required': True, 'type': 'list', 'schema': {'type': 'string', 'regex': FILE_KEY_REGEX}, 'doc': 'files keys on S3 bucket.'},
+    'max_concurrency': {'type': 'integer', 'min': 1, 'doc': 'maximum number of files read at the same time. Defaults to 32.'},
+    'cache': {'type': 'boolean', 'doc': 'same as read_json_file.'},
+    'cache_ttl': {'type': 'number', 'doc': 'same as read_json_file.'}
+}, engine='compiled')
+def read_json_files(**kwargs):
+    """Read content of many S3 files as json, concurrently.
+
+    The files are read on a thread pool sharing the same S3 client (and connection pool). A file
+    that cannot be read or decoded does not stop the others: its error is returned instead.
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs.
+
+    Returns:
+        A dict { 'results': { 'file_key': data }, 'errors': { 'file_key': 'error message' } }
+    """    
+    try:
+        s3 = get_client('s3')
+        cache = kwargs.get('cache', False) or 'cache_ttl' in kwargs
+        file_keys = list(dict.fromkeys(kwargs['file_keys']))
+        results = {}
+        errors = {}
+
+        def read(file_key):
+            return _read_json(s3, kwargs['bucket_name'], file_key, cache, kwargs.get('cache_ttl'))
+
+        with ThreadPoolExecutor(max_workers=max(1, min(kwargs.get('max_concurrency', 32), len(file_keys)))) as executor:
+            futures = {executor.submit(read, file_key): file_key for file_key in file_keys}
+
+            for future, file_key in futures.items():
+                try:
+                    results[file_key] = future.result()
+                except Exception as e:
+                    errors[file_key] = str(e)
+
+        return { 'results': results, 'errors': errors }
+
+    except Exception as e:
+        raise e
+
+#------------------------------------------------------------------------------------------------------
+#  _read_json
+#------------------------------------------------------------------------------------------------------
+def _read_json(s3, bucket_name, file_key, cache=False, ttl=None):
+    if cache:
+        return _cached_json(s3, bucket_name, file_key, ttl)
+
+    etag, body = _get_object(s3, bucket_name, file_key)
+
+    return json.loads(body.decode('utf-8'))
+
+#------------------------------------------------------------------------------------------------------
+#  _cached_json
+#------------------------------------------------------------------------------------------------------
+def _cached_json(s3, bucket_name, file_key, ttl):
+    return _cached_object(json_cache, (bucket_name, file_key), s3, bucket_name, file_key, ttl,
+                          lambda body: freeze(json.loads(body.decode('utf-8'))))
+
+#------------------------------------------------------------------------------------------------------
+#  _cached_object
+#------------------------------------------------------------------------------------------------------
+def _cached_object(cache, key, s3, bucket_name, file_key, ttl, parse):
+    cached = cache.get(key, record=False)
+    now = time.monotonic()
+
+    if cached is not None:
+        if ttl is not None and now - cached['validated_at'] <= ttl:
+            cache.record(True)
+            return cached['data']
+
+        try:
+            etag, body = _get_object(s3, bucket_name, file_key, IfNoneMatch=cached['etag'])
+        except s3.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('304', 'NotModified'):
+                raise
+            cached['validated_at'] = now
+            cache.record(True)
+            return cached['data']
+    else:
+        etag, body = _get_object(s3, bucket_name, file_key)
+
+    cached = {'etag': etag, 'data': parse(body), 'validated_at': now}
+    cache.put(key, cached, size=len(body))
+    cache.record(False)
+
+    return cached['data']
+
+#######################################################################################################
+#
+#  iter_json_array
+#
+#######################################################################################################
+@safe_kwargs({
+    'bucket_name': {'required': True, 'type': 'string', 'doc': 'S3 bucket name.'},
+    'file_key': {'required': True, 'type': 'string', 'regex': FILE_KEY_REGEX, 'doc': 'file key on S3 bucket.'},
+    'chunk_size': {'type': 'integer', 'doc': 'size in bytes of each read from S3. Defaults to 64 KiB.'}
+}, engine='compiled')
+def iter_json_array(**kwargs):
+    """Iterate over the elements of a S3 file holding a top-level json array, without loading the whole file.
+
+    The file is read in chunks and each element is decoded as soon as it is complete, so memory is
+    bounded by the size of the largest element rather than by the size of the file. A compressed
+    file is decompressed chunk by chunk (see CODECS).
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs, or if the file is not a valid json array.
+
+    Yields:
+        Each element of the array, decoded as json.
+    """    
+    try:
+        s3 = get_client('s3')
+        obj = s3.get_object(Bucket=kwargs['bucket_name'], Key=kwargs['file_key'])
+
+        try:
+            yield from _iter_json_array(_iter_body(obj, kwargs['file_key'], kwargs.get('chunk_size', STREAM_CHUNK_SIZE)))
+        finally:
+            obj['Body'].close()
+
+    except Exception as e:
+        raise e
+
+#######################################################################################################
+#
+#  iter_json_lines
+#
+#######################################################################################################
+@safe_kwargs({
+    'bucket_name': {'required': True, 'type': 'string', 'doc': 'S3 bucket name.'},
+    'file_key': {'required': True, 'type': 'string', 'regex': FILE_KEY_REGEX, 'doc': 'file key on S3 bucket.'},
+    'chunk_size': {'type': 'integer', 'doc': 'size in bytes of each read from S3. Defaults to 64 KiB.'}
+}, engine='compiled')
+def iter_json_lines(**kwargs):
+    """Iterate over the records of a S3 file in JSON Lines format, one line at a time.
+
+    Blank lines are skipped. A compressed file is decompressed chunk by chunk (see CODECS).
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs, or if a line is not valid json.
+
+    Yields:
+        Each line, decoded as json.
+    """    
+    try:
+        s3 = get_client('s3')
+        obj = s3.get_object(Bucket=kwargs['bucket_name'], Key=kwargs['file_key'])
+
+        try:
+            for line in _iter_lines(_iter_body(obj, kwargs['file_key'], kwargs.get('chunk_size', STREAM_CHUNK_SIZE))):
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            obj['Body'].close()
 
     except Exception as e:
         raise e
+
+#------------------------------------------------------------------------------------------------------
+#  _iter_json_array
+#------------------------------------------------------------------------------------------------------
+def _iter_json_array(chunks):
+    chunks = iter(chunks)
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    whitespace = json.decoder.WHITESPACE
+    buffer = ''
+    pos = 0
+    eof = False
+    expected = '['
+    wanted = 1
+
+    while True:
+        pos = whitespace.match(buffer, pos).end()
+
+        if len(buffer) - pos < wanted and not eof:
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+                buffer = buffer[pos:] + text_decoder.decode(b'', final=True)
+            else:
+                buffer = buffer[pos:] + text_decoder.decode(chunk)
+            pos = 0
+            continue
+
+        wanted = 1
+        if pos == len(buffer) and expected != 'end':
+            raise json.JSONDecodeError('Unexpected end of json array', buffer, pos)
+
+        if expected == '[':
+            if buffer[pos] != '[':
+                raise json.JSONDecodeError('Expecting top-level json array', buffer, pos)
+            pos += 1
+            expected = 'first'
+
+        elif expected in ('first', 'next') and buffer[pos] == ']':
+            pos += 1
+            expected = 'end'
+
+        elif expected == 'next':
+            if buffer[pos] != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+            pos += 1
+            expected = 'value'
+
+        elif expected in ('first', 'value'):
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # Incomplete element: wait for twice as much text, so large elements are decoded
+                # a logarithmic number of times instead of once per chunk.
+                wanted = 2 * (len(buffer) - pos)
+                continue
+
+            if not eof and (end == len(buffer) or type(value) in (int, float) and NUMBER_TAIL_REGEX.fullmatch(buffer, end)):
+                # A number (or literal) ending with the buffer may go on in the next chunk. raw_decode
+                # also stops early on a number cut in its fraction or exponent ('1.', '1e-'), leaving
+                # the rest of it at the end of the buffer.
+                wanted = len(buffer) - pos + 1
+                continue
+
+            pos = end
+            expected = 'next'
+            yield value
+
+        else:
+            if pos != len(buffer):
+                raise json.JSONDecodeError('Extra data', buffer, pos)
+            return
+
+#######################################################################################################
+#
+#  configure_transfers
+#
+#######################################################################################################
+@safe_kwargs({
+    'threshold': {'type': 'integer', 'min': 1, 'doc': 'size in bytes above which files are transferred in parts. Defaults to 16 MiB.'},
+    'part_size': {'type': 'integer', 'min': MIN_PART_SIZE, 'doc': 'size in bytes of each part, at least 5 MiB. Defaults to 8 MiB.'},
+    'max_concurrency': {'type': 'integer', 'min': 1, 'doc': 'maximum number of parts of a file transferred at the same time. Defaults to 10.'},
+    'max_attempts': {'type': 'integer', 'min': 1, 'doc': 'maximum number of attempts of each part, on top of the client retries. Defaults to 3.'}
+}, engine='compiled')
+def configure_transfers(**kwargs):
+    """Configure the transfer engine used by the functions of this module to read and write files.
+
+    Files larger than threshold are read with concurrent ranged GETs and written with a concurrent
+    multipart upload, over the shared S3 client connection pool.
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs.
+
+    Returns:
+        The current configuration dict.
+    """
+    try:
+        _transfer_config.update({key: kwargs[key] for key in DEFAULT_TRANSFER_CONFIG if key in kwargs})
+        return dict(_transfer_config)
+
+    except Exception as e:
+        raise e
+
+#######################################################################################################
+#
+#  read_file
+#
+#######################################################################################################
+@safe_kwargs({
+    'bucket_name': {'required': True, 'type': 'string', 'doc': 'S3 bucket name.'},
+    'file_key': {'required': True, 'type': 'string', 'regex': FILE_KEY_REGEX, 'doc': 'file key on S3 bucket.'},
+    'decompress': {'type': 'boolean', 'doc': 'decompress a compressed file (see CODECS). Defaults to True.'}
+}, engine='compiled')
+def read_file(**kwargs):
+    """Read content of S3 file, in concurrent parts above the transfer threshold (see configure_transfers).
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs.
+
+    Returns:
+        File content as bytes.
+    """    
+    try:
+        s3 = get_client('s3')
+        etag, body = _get_object(s3, kwargs['bucket_name'], kwargs['file_key'], decompress=kwargs.get('decompress', True))
+
+        return bytes(body)
+
+    except Exception as e:
+        raise e
+
+#######################################################################################################
+#
+#  write_file
+#
+#######################################################################################################
+@safe_kwargs({
+    'bucket_name': {'required': True, 'type': 'string', 'doc': 'S3 bucket name.'},
+    'file_key': {'required': True, 'type': 'string', 'regex': FILE_KEY_REGEX, 'doc': 'file key on S3 bucket.'},
+    'body': {'required': True, 'type': ['string', 'binary'], 'doc': 'file content. Strings are encoded as UTF-8.'},
+    'compression': {'type': 'string', 'allowed': list(CODECS), 'doc': 'compress the file and set its ContentEncoding.'}
+}, engine='compiled')
+def write_file(**kwargs):
+    """Save content as S3 file, with a concurrent multipart upload above the transfer threshold (see configure_transfers).
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs.
+
+    Returns:
+        File key.
+    """    
+    try:
+        s3 = get_client('s3')
+        body = kwargs['body'].encode('utf-8') if isinstance(kwargs['body'], str) else kwargs['body']
+        _put_object(s3, kwargs['bucket_name'], kwargs['file_key'], _compress(body, kwargs.get('compression')),
+                    **_encoding_params(kwargs.get('compression')))
+
+        return kwargs['file_key']
+
+    except Exception as e:
+        raise e
+
+#------------------------------------------------------------------------------------------------------
+#  _get_object
+#------------------------------------------------------------------------------------------------------
+def _get_object(s3, bucket_name, file_key, decompress=True, **params):
+    # The first GET asks for the first threshold bytes: smaller files need no other request, larger
+    # ones get their size from ContentRange and the rest is read with concurrent ranged GETs pinned
+    # to the same ETag (IfMatch), so a file replaced meanwhile fails instead of being mixed.
+    config = dict(_transfer_config)
+    try:
+        obj = s3.get_object(Bucket=bucket_name, Key=file_key, Range=f"bytes=0-{config['threshold'] - 1}", **params)
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidRange':
+            raise
+        # Empty files have no satisfiable range.
+        obj = s3.get_object(Bucket=bucket_name, Key=file_key, **params)
+        return obj['ETag'], obj['Body'].read()
+
+    first = obj['Body'].read()
+    size = int(obj['ContentRange'].rsplit('/', 1)[1]) if obj.get('ContentRange') else len(first)
+    codec = _detect_codec(obj, file_key, first) if decompress else None
+    if size <= len(first):
+        return obj['ETag'], _decompress(first, codec)
+
+    body = bytearray(size)
+    body[:len(first)] = first
+    ranges = [(start, min(start + config['part_size'], size)) for start in range(len(first), size, config['part_size'])]
+
+    def get_range(start, end):
+        response = s3.get_object(Bucket=bucket_name, Key=file_key, Range=f"bytes={start}-{end - 1}", IfMatch=obj['ETag'])
+        body[start:end] = response['Body'].read()
+
+    with ThreadPoolExecutor(max_workers=min(config['max_concurrency'], len(ranges))) as executor:
+        futures = [executor.submit(_with_retries, get_range, config['max_attempts'], start, end) for start, end in ranges]
+        for future in futures:
+            future.result()
+
+    return obj['ETag'], _decompress(body, codec)
+
+#------------------------------------------------------------------------------------------------------
+#  _put_object
+#------------------------------------------------------------------------------------------------------
+def _put_object(s3, bucket_name, file_key, body, **params):
+    config = dict(_transfer_config)
+    if len(body) <= config['threshold']:
+        s3.put_object(Bucket=bucket_name, Key=file_key, Body=bytes(body), **params)
+        return
+
+    part_size = max(config['part_size'], -(-len(body) // MAX_PARTS))
+    view = memoryview(body)
+    upload_id = s3.create_multipart_upload(Bucket=bucket_name, Key=file_key, **params)['UploadId']
+
+    try:
+        with ThreadPoolExecutor(max_workers=config['max_concurrency']) as executor:
+            futures = [
+                executor.submit(_upload_part, s3, bucket_name, file_key, upload_id, part_number, view[start:start + part_size], config['max_attempts'])
+                for part_number, start in enumerate(range(0, len(body), part_size), start=1)
+            ]
+            parts = [future.result() for future in futures]
+
+        s3.complete_multipart_upload(Bucket=bucket_name, Key=file_key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket_name, Key=file_key, UploadId=upload_id)
+        raise
+
+#------------------------------------------------------------------------------------------------------
+#  _upload_part
+#------------------------------------------------------------------------------------------------------
+def _upload_part(s3, bucket_name, file_key, upload_id, part_number, data, max_attempts):
+    def upload():
+        return s3.upload_part(Bucket=bucket_name, Key=file_key, UploadId=upload_id, PartNumber=part_number,
+                              Body=data if isinstance(data, (bytes, bytearray)) else bytes(data))
+
+    return {'PartNumber': part_number, 'ETag': _with_retries(upload, max_attempts)['ETag']}
+
+#------------------------------------------------------------------------------------------------------
+#  _with_retries
+#------------------------------------------------------------------------------------------------------
+def _with_retries(func, max_attempts, *args):
+    # botocore retries failed requests, but not a body read interrupted after the response headers,
+    # so each part is retried as a whole on connection errors and 5xx answers.
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    for attempt in range(max_attempts):
+        try:
+            return func(*args)
+        except (BotoCoreError, ClientError) as e:
+            retryable = isinstance(e, BotoCoreError) or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+            if not retryable or attempt == max_attempts - 1:
+                raise
+            time.sleep(min(0.1 * 2 ** attempt, 2))
+
+#------------------------------------------------------------------------------------------------------
+#  _detect_codec
+#------------------------------------------------------------------------------------------------------
+def _detect_codec(obj, file_key, head):
+    encoding = (obj.get('ContentEncoding') or '').split(',')[0].strip().lower()
+    for name, codec in CODECS.items():
+        if encoding in codec['encodings']:
+            return name
+    for name, codec in CODECS.items():
+        if file_key.endswith(codec['extension']):
+            return name
+    for name, codec in CODECS.items():
+        if codec['magic'].match(head):
+            return name
+    return None
+
+#------------------------------------------------------------------------------------------------------
+#  _encoding_params
+#------------------------------------------------------------------------------------------------------
+def _encoding_params(codec):
+    return {'ContentEncoding': codec} if codec else {}
+
+#------------------------------------------------------------------------------------------------------
+#  _compressor
+#------------------------------------------------------------------------------------------------------
+def _compressor(codec):
+    # Codec modules are imported on first use. gzip goes through zlib, whose header has no mtime
+    # or file name, so the same content always compresses to the same bytes (and ETag).
+    if codec == 'gzip':
+        import zlib
+        return zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    if codec == 'bzip2':
+        import bz2
+        return bz2.BZ2Compressor()
+    import lzma
+    return lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+
+#------------------------------------------------------------------------------------------------------
+#  _decompressor
+#------------------------------------------------------------------------------------------------------
+def _decompressor(codec):
+    if codec == 'gzip':
+        import zlib
+        return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    if codec == 'bzip2':
+        import bz2
+        return bz2.BZ2Decompressor()
+    import lzma
+    return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+#------------------------------------------------------------------------------------------------------
+#  _compress
+#------------------------------------------------------------------------------------------------------
+def _compress(data, codec):
+    if not codec:
+        return data
+    compressor = _compressor(codec)
+    return compressor.compress(data) + compressor.flush()
+
+#------------------------------------------------------------------------------------------------------
+#  _decompress
+#------------------------------------------------------------------------------------------------------
+def _decompress(data, codec):
+    if not codec:
+        return data
+    return b''.join(_decompress_chunks([data], codec))
+
+#------------------------------------------------------------------------------------------------------
+#  _decompress_chunks
+#------------------------------------------------------------------------------------------------------
+def _decompress_chunks(chunks, codec, max_length=STREAM_CHUNK_SIZE):
+    # Concatenated streams (e.g. appended gzip members) are decompressed one after the other. Output is
+    # produced max_length bytes at a time, so a highly compressed chunk never expands in one piece.
+    decompressor = _decompressor(codec)
+    for chunk in chunks:
+        pending = bool(chunk)
+        while pending:
+            if decompressor.eof:
+                decompressor = _decompressor(codec)
+            data = decompressor.decompress(chunk, max_length)
+            if data:
+                yield data
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                pending = bool(chunk)
+            else:
+                # zlib hands back the input it has not consumed yet; bz2 and lzma keep it and clear needs_input.
+                chunk = getattr(decompressor, 'unconsumed_tail', b'')
+                pending = bool(chunk) or not getattr(decompressor, 'needs_input', len(data) < max_length)
+
+    if not decompressor.eof:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+#------------------------------------------------------------------------------------------------------
+#  _iter_body
+#------------------------------------------------------------------------------------------------------
+def _iter_body(obj, file_key, chunk_size=None):
+    chunks = obj['Body'].iter_chunks(chunk_size or STREAM_CHUNK_SIZE)
+    first = next(chunks, b'')
+    codec = _detect_codec(obj, file_key, first)
+    chunks = chain([first], chunks)
+
+    return _decompress_chunks(chunks, codec) if codec else chunks
+
+#------------------------------------------------------------------------------------------------------
+#  _iter_lines
+#------------------------------------------------------------------------------------------------------
+def _iter_lines(chunks):
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).splitlines()
+        # The last line may go on in the next chunk, unless the chunk ends with a line break.
+        pending = lines.pop() if lines and not chunk.endswith((b'\n', b'\r')) else b''
+        yield from lines
+    if pending:
+        yield pending
@@ -1,10 +1,14 @@
-from cerberus import Validator, schema_registry
-from functools import wraps
+import re
+import threading
+from collections.abc import Iterable, Mapping, Sequence
+from datetime import date, datetime
+from functools import lru_cache, wraps
 
 DOC_PLACEHOLDER = '${safe_kwargs}'
 DOC_TYPE_MAP = {
     'string': 'str',
     'bytes': 'bytes',
+    'binary': 'bytes',
     'integer': 'int',
     'float': 'float',
     'number': 'int or float',
@@ -13,7 +17,29 @@ DOC_TYPE_MAP = {
     'date': 'datetime.date',
     'dict': 'dict',
     'list': 'list',
-    'set': 'set'
+    'set': 'set',
+    'iterable': 'iterable',
+    'ipv4_network': 'str (IPv4 network)',
+    'ipv6_network': 'str (IPv6 network)'
+}
+
+# Rules handled natively by the 'compiled' engine. Fields using any other rule (oneof, allof,
+# dependencies, excludes...) are validated by Cerberus.
+COMPILED_RULES = {'doc', 'meta', 'required', 'nullable', 'type', 'regex', 'minlength', 'allowed', 'schema', 'keysrules', 'valuesrules'}
+# Same semantics as Cerberus' types_mapping: (included types, excluded types).
+COMPILED_TYPES = {
+    'binary': ((bytes, bytearray), ()),
+    'boolean': ((bool,), ()),
+    'date': ((date,), ()),
+    'datetime': ((datetime,), ()),
+    'dict': ((Mapping,), ()),
+    'float': ((float, int), ()),
+    'integer': ((int,), ()),
+    'iterable': ((Iterable,), (str, bytes, bytearray, Mapping)),
+    'list': ((Sequence,), (str,)),
+    'number': ((int, float), (bool,)),
+    'set': ((set,), ()),
+    'string': ((str,), ())
 }
 
 #######################################################################################################
@@ -21,27 +47,401 @@ DOC_TYPE_MAP = {
 #  @safe_kwargs
 #
 #######################################################################################################
-def safe_kwargs(schema):
+def safe_kwargs(schema, engine='cerberus'):
+    """Validate the kwargs of the decorated function against a Cerberus schema.
+
+    Args:
+        schema: Cerberus schema of the kwargs. Unknown kwargs are allowed.
+        engine: 'cerberus' validates with SafeKwargsValidator. 'compiled' turns the schema into
+            plain Python checks and only hands the fields using rules outside COMPILED_RULES over to
+            Cerberus. Both engines report identical errors.
+
+    Raises:
+        ValueError: from the decorated function, in case of missing or invalid kwargs.
+    """
+    if engine == 'cerberus':
+        prepare = _prepare_validator
+    elif engine == 'compiled':
+        prepare = _compile_validator
+    else:
+        raise ValueError(f"unknown engine '{engine}'")
+
     def wrapper(func):
+        validate = prepare(schema)
+
         @wraps(func)
         def validate_kwargs(*args, **kwargs):
-            schema_name = f"{args[0].__class__.__name__}.{func.__name__}" if len(args) else func.__name__
-            schema_registry.add(schema_name, schema)
-            v = SafeKwargsValidator(schema, allow_unknown=True)
-            if not v.validate(kwargs, schema_registry.get(schema_name)):
-                raise ValueError(v.errors)
+            errors = validate(kwargs)
+            if errors:
+                raise ValueError(errors)
             return func(*args, **kwargs)
         validate_kwargs.__doc__ = _expand_docstring(func.__doc__, schema)
+        validate_kwargs.validate = validate
         return validate_kwargs
     return wrapper
 
+#######################################################################################################
+#
+#  validate_many
+#
+#######################################################################################################
+def validate_many(func, kwargs_list):
+    """Validate many kwargs dicts against the schema of a @safe_kwargs decorated function.
+
+    All the dicts share the validator prepared for the function and nothing is raised for invalid
+    ones, so a whole batch can be screened before being processed.
+
+    Args:
+        func: function (or method) decorated with @safe_kwargs.
+        kwargs_list: iterable of kwargs dicts.
+
+    Raises:
+        ValueError: if func is not decorated with @safe_kwargs.
+
+    Returns:
+        A list with the errors of each kwargs dict, in order. Valid dicts get an empty dict.
+    """
+    validate = getattr(func, 'validate', None)
+    if validate is None:
+        raise ValueError(f"{func.__name__} is not decorated with @safe_kwargs")
+
+    return [validate(kwargs) if isinstance(kwargs, Mapping) else {'kwargs': ['must be of dict type']} for kwargs in kwargs_list]
+
+#######################################################################################################
+#
+#  normalize_network
+#
+#######################################################################################################
+def normalize_network(value, version):
+    """Return the canonical form of an IP network, e.g. '192.168.0.1' -> '192.168.0.1/32'.
+
+    Parsing is cached and shared with the ipv4_network and ipv6_network types, so values already
+    validated by @safe_kwargs are not parsed again.
+
+    Args:
+        value: network as a string (address or CIDR) or as an ipaddress network object.
+        version: IP version, 4 or 6.
+
+    Raises:
+        ValueError: if value is not a valid network of the given version.
+
+    Returns:
+        The network as a string in CIDR notation.
+    """
+    network = _parse_network(str(value), version) if isinstance(value, str) or _is_network_object(value) else None
+    if network is None:
+        raise ValueError(f"'{value}' is not a valid IPv{version} network")
+    return network
+
+#------------------------------------------------------------------------------------------------------
+#  IPv4NetworkType / IPv6NetworkType
+#------------------------------------------------------------------------------------------------------
+class _NetworkTypeMeta(type):
+    # isinstance() support lets the network types be plain Cerberus TypeDefinitions.
+    def __instancecheck__(cls, value):
+        return _is_network(value, cls.version)
+
+class IPv4NetworkType(metaclass=_NetworkTypeMeta):
+    version = 4
+
+class IPv6NetworkType(metaclass=_NetworkTypeMeta):
+    version = 6
+
+COMPILED_TYPES['ipv4_network'] = ((IPv4NetworkType,), ())
+COMPILED_TYPES['ipv6_network'] = ((IPv6NetworkType,), ())
+
+#------------------------------------------------------------------------------------------------------
+#  _is_network
+#------------------------------------------------------------------------------------------------------
+def _is_network(value, version):
+    if isinstance(value, str):
+        return _parse_network(value, version) is not None
+    return _is_network_object(value) and value.version == version
+
+#------------------------------------------------------------------------------------------------------
+#  _is_network_object
+#------------------------------------------------------------------------------------------------------
+def _is_network_object(value):
+    import ipaddress
+    return isinstance(value, (ipaddress.IPv4Network, ipaddress.IPv6Network))
+
+#------------------------------------------------------------------------------------------------------
+#  _parse_network
+#------------------------------------------------------------------------------------------------------
+@lru_cache(maxsize=65536)
+def _parse_network(value, version):
+    import ipaddress
+    try:
+        network = ipaddress.ip_network(value)
+    except ValueError:
+        return None
+    return str(network) if network.version == version else None
+
 #------------------------------------------------------------------------------------------------------
 #  SafeKwargsValidator
 #------------------------------------------------------------------------------------------------------
-class SafeKwargsValidator(Validator):
-    def _validate_doc(self, constraint, field, value):
-        "{'type': 'string'}"
-        pass
+_validator_class_lock = threading.Lock()
+_SafeKwargsValidator = None
+
+def __getattr__(name):
+    if name == 'SafeKwargsValidator':
+        return _validator_class()
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+def _validator_class():
+    # Importing Cerberus is deferred until a Cerberus validator is actually needed.
+    global _SafeKwargsValidator
+    with _validator_class_lock:
+        if _SafeKwargsValidator is None:
+            from cerberus import TypeDefinition, Validator
+
+            class SafeKwargsValidator(Validator):
+                def _validate_doc(self, constraint, field, value):
+                    "{'type': 'string'}"
+                    pass
+
+                types_mapping = Validator.types_mapping.copy()
+                types_mapping['iterable'] = TypeDefinition('iterable', *COMPILED_TYPES['iterable'])
+                types_mapping['ipv4_network'] = TypeDefinition('ipv4_network', (IPv4NetworkType,), ())
+                types_mapping['ipv6_network'] = TypeDefinition('ipv6_network', (IPv6NetworkType,), ())
+
+            SafeKwargsValidator.__qualname__ = 'SafeKwargsValidator'
+            _SafeKwargsValidator = SafeKwargsValidator
+    return _SafeKwargsValidator
+
+#------------------------------------------------------------------------------------------------------
+#  _prepare_validator
+#------------------------------------------------------------------------------------------------------
+def _prepare_validator(schema):
+    # The schema is normalized and checked only once, on the first call. Cerberus validators keep
+    # per-document state, so each thread gets its own instance sharing the already checked definition.
+    lock = threading.Lock()
+    local = threading.local()
+    prepared = {}
+
+    def validate(document):
+        v = getattr(local, 'validator', None)
+        if v is None:
+            validator_class = _validator_class()
+            with lock:
+                if not prepared:
+                    prepared['definition'] = validator_class(schema, allow_unknown=True).schema
+                    prepared['normalize'] = _has_normalization_rules(schema, validator_class.normalization_rules)
+            v = local.validator = validator_class(prepared['definition'], allow_unknown=True)
+        if v.validate(document, normalize=prepared['normalize']):
+            return {}
+        return v.errors
+
+    return validate
+
+#------------------------------------------------------------------------------------------------------
+#  _compile_validator
+#------------------------------------------------------------------------------------------------------
+def _compile_validator(schema):
+    fallback_fields = {field for field, rules in schema.items() if not _is_compilable(rules)}
+
+    # Excluded fields change how requiredness is checked, so they go to Cerberus together.
+    pending = list(fallback_fields)
+    while pending:
+        excludes = schema[pending.pop()].get('excludes', [])
+        for field in ([excludes] if isinstance(excludes, str) else excludes):
+            if field in schema and field not in fallback_fields:
+                fallback_fields.add(field)
+                pending.append(field)
+
+    check = _compile_mapping({field: rules for field, rules in schema.items() if field not in fallback_fields})
+    if not fallback_fields:
+        return check
+
+    fallback = _prepare_validator({field: rules for field, rules in schema.items() if field in fallback_fields})
+
+    def validate(document):
+        errors = check(document)
+        fallback_errors = fallback(document)
+        if fallback_errors:
+            errors.update(fallback_errors)
+        return errors
+
+    return validate
+
+#------------------------------------------------------------------------------------------------------
+#  _is_compilable
+#------------------------------------------------------------------------------------------------------
+def _is_compilable(rules):
+    if not isinstance(rules, dict) or not COMPILED_RULES.issuperset(rules):
+        return False
+
+    types = rules.get('type', [])
+    types = [types] if isinstance(types, str) else types
+    if not isinstance(types, (list, tuple)) or not all(type in COMPILED_TYPES for type in types):
+        return False
+    if not isinstance(rules.get('regex', ''), str) or not isinstance(rules.get('nullable', False), bool):
+        return False
+
+    if 'schema' in rules:
+        if rules.get('type') == 'list':
+            if not _is_compilable(rules['schema']):
+                return False
+        elif rules.get('type') == 'dict':
+            if not isinstance(rules['schema'], dict) or not all(_is_compilable(r) for r in rules['schema'].values()):
+                return False
+        else:
+            return False
+
+    return all(_is_compilable(rules[rule]) for rule in ('keysrules', 'valuesrules') if rule in rules)
+
+#------------------------------------------------------------------------------------------------------
+#  _compile_mapping
+#------------------------------------------------------------------------------------------------------
+def _compile_mapping(schema):
+    fields = [(field, _compile_rules(rules), rules.get('required', False) is True) for field, rules in schema.items()]
+
+    def check(document):
+        errors = {}
+        for field, check_value, required in fields:
+            if field in document:
+                field_errors = check_value(document[field])
+                if field_errors:
+                    errors[field] = field_errors
+            elif required:
+                errors[field] = ['required field']
+        return errors
+
+    return check
+
+#------------------------------------------------------------------------------------------------------
+#  _compile_rules
+#------------------------------------------------------------------------------------------------------
+def _compile_rules(rules):
+    # Error messages and their order mirror Cerberus' BasicErrorHandler: messages sorted by rule
+    # name, followed by the errors of the keysrules, schema and valuesrules child documents.
+    nullable = rules.get('nullable', False)
+    type_check = _compile_type(rules['type']) if rules.get('type') else None
+    type_error = [f"must be of {rules.get('type')} type"]
+    checks = []
+    child_checks = []
+
+    if 'allowed' in rules:
+        allowed = rules['allowed']
+
+        def check_allowed(value):
+            if isinstance(value, Iterable) and not isinstance(value, str):
+                unallowed = tuple(x for x in value if x not in allowed)
+                if unallowed:
+                    return f"unallowed values {unallowed}"
+            elif value not in allowed:
+                return f"unallowed value {value}"
+        checks.append(check_allowed)
+
+    if 'minlength' in rules:
+        min_length = rules['minlength']
+        min_length_error = f"min length is {min_length}"
+
+        def check_minlength(value):
+            if isinstance(value, Iterable) and len(value) < min_length:
+                return min_length_error
+        checks.append(check_minlength)
+
+    if 'regex' in rules:
+        pattern = rules['regex']
+        regex = re.compile(pattern if pattern.endswith('$') else pattern + '$')
+        regex_error = f"value does not match regex '{pattern}'"
+
+        def check_regex(value):
+            if isinstance(value, str) and not regex.match(value):
+                return regex_error
+        checks.append(check_regex)
+
+    if 'keysrules' in rules:
+        check_key = _compile_rules(rules['keysrules'])
+
+        def check_keysrules(value):
+            if isinstance(value, Mapping):
+                return _collect_errors((key, check_key(key)) for key in value)
+        child_checks.append(check_keysrules)
+
+    if 'schema' in rules and rules['type'] == 'list':
+        check_item = _compile_rules(rules['schema'])
+
+        def check_schema(value):
+            if isinstance(value, Sequence) and not isinstance(value, str):
+                return _collect_errors((i, check_item(item)) for i, item in enumerate(value))
+        child_checks.append(check_schema)
+    elif 'schema' in rules:
+        check_mapping = _compile_mapping(rules['schema'])
+
+        def check_schema(value):
+            if isinstance(value, Mapping):
+                return check_mapping(value)
+        child_checks.append(check_schema)
+
+    if 'valuesrules' in rules:
+        check_item = _compile_rules(rules['valuesrules'])
+
+        def check_valuesrules(value):
+            if isinstance(value, Mapping):
+                return _collect_errors((key, check_item(item)) for key, item in value.items())
+        child_checks.append(check_valuesrules)
+
+    def check(value):
+        if value is None:
+            return None if nullable else ['null value not allowed']
+        if type_check is not None and not type_check(value):
+            return type_error
+
+        errors = [error for error in (rule_check(value) for rule_check in checks) if error is not None]
+        children = {}
+        for child_check in child_checks:
+            child_errors = child_check(value)
+            if child_errors:
+                _merge_errors(children, child_errors)
+        if children:
+            errors.append(children)
+        return errors
+
+    return check
+
+#------------------------------------------------------------------------------------------------------
+#  _compile_type
+#------------------------------------------------------------------------------------------------------
+def _compile_type(type):
+    types = [COMPILED_TYPES[t] for t in ([type] if isinstance(type, str) else type)]
+    return lambda value: any(isinstance(value, included) and not isinstance(value, excluded) for included, excluded in types)
+
+#------------------------------------------------------------------------------------------------------
+#  _collect_errors
+#------------------------------------------------------------------------------------------------------
+def _collect_errors(items):
+    return {key: errors for key, errors in items if errors}
+
+#------------------------------------------------------------------------------------------------------
+#  _merge_errors
+#------------------------------------------------------------------------------------------------------
+def _merge_errors(tree, other):
+    for key, errors in other.items():
+        if key not in tree:
+            tree[key] = errors
+            continue
+        messages = [error for error in tree[key] if not isinstance(error, dict)]
+        messages += [error for error in errors if not isinstance(error, dict)]
+        children = {}
+        for error in tree[key] + errors:
+            if isinstance(error, dict):
+                _merge_errors(children, error)
+        tree[key] = messages + ([children] if children else [])
+
+#------------------------------------------------------------------------------------------------------
+#  _has_normalization_rules
+#------------------------------------------------------------------------------------------------------
+def _has_normalization_rules(schema, normalization_rules):
+    # Normalizing copies and re-checks the whole schema on every call, so it is only done when
+    # the schema asks for it (coerce, default, rename...).
+    if isinstance(schema, dict):
+        return any(key in normalization_rules or _has_normalization_rules(value, normalization_rules)
+                   for key, value in schema.items())
+    if isinstance(schema, (list, tuple)):
+        return any(_has_normalization_rules(value, normalization_rules) for value in schema)
+    return False
 
 #------------------------------------------------------------------------------------------------------
 #  _expand_docstring
@@ -65,12 +465,15 @@ def _generate_kwargs_doc(schema, offset):
     indent = ' ' * 4
 
     for key, value in schema.items():
-        type = DOC_TYPE_MAP[value['type']]
+        types = [value['type']] if isinstance(value['type'], str) else value['type']
+        type = ' or '.join(DOC_TYPE_MAP[type] for type in types)
         if value['type'] == 'list' and value.get('schema', ''):
             type += f" of {DOC_TYPE_MAP[value['schema']['type']]}"
         type += ', optional' if not value.get('required', False) else ''
         doc += f"{key} ({type}): {value.get('doc', key)}{linebreak}"
         if value['type'] == 'dict' and value.get('schema', ''):
             doc += indent + _generate_kwargs_doc(value['schema'], offset + 4) + linebreak
+        elif value['type'] == 'list' and value.get('schema', {}).get('type') == 'dict' and value['schema'].get('schema', ''):
+            doc += indent + _generate_kwargs_doc(value['schema']['schema'], offset + 4) + linebreak
 
     return doc[0:doc.rfind('\n')]
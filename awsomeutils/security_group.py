@@ -1,23 +1,25 @@
-import boto3
-import ipaddress
-from .safe_kwargs import safe_kwargs
+from concurrent.futures import ThreadPoolExecutor
+from .clients import get_client
+from .safe_kwargs import normalize_network, safe_kwargs
 
-IPV4_REGEX = r'^((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)(/([0-9]|[0-2][0-9]|3[0-2]))?$'
-IPV6_REGEX = r'^(([0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,7}:|([0-9a-fA-F]{1,4}:){1,6}:[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,5}(:[0-9a-fA-F]{1,4}){1,2}|([0-9a-fA-F]{1,4}:){1,4}(:[0-9a-fA-F]{1,4}){1,3}|([0-9a-fA-F]{1,4}:){1,3}(:[0-9a-fA-F]{1,4}){1,4}|([0-9a-fA-F]{1,4}:){1,2}(:[0-9a-fA-F]{1,4}){1,5}|[0-9a-fA-F]{1,4}:((:[0-9a-fA-F]{1,4}){1,6})|:((:[0-9a-fA-F]{1,4}){1,7}|:)|fe80:(:[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}|::(ffff(:0{1,4}){0,1}:){0,1}((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])|([0-9a-fA-F]{1,4}:){1,4}:((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9]))(\/((1(1[0-9]|2[0-8]))|([0-9][0-9])|([0-9])))?$'
+RULE_SCHEMA = {
+    'security_group_id': {'required': True, 'type': 'string', 'doc': 'the ID of the security group.'},
+    'comment': {'type': 'string', 'doc': 'rule\'s description.'},
+    'port': {'required': True, 'type': 'integer', 'doc': 'port for TCP and UDP protocols.'},
+    'protocol': {'required': True, 'type': 'string', 'doc': 'IP protocol name (tcp, udp, icmp, icmpv6) or -1 to specify all protocols.'},
+    'allowed_ipv4_addresses': {'required': True, 'type': 'list', 'schema': {'type': 'ipv4_network'}, 'doc': 'IPv4 ranges. Use /32 to single IPv4 address.'},
+    'allowed_ipv6_addresses': {'required': True, 'type': 'list', 'schema': {'type': 'ipv6_network'}, 'doc': 'IPv6 ranges. Use /128 to single IPv6 address.'},
+    'aggregate': {'type': 'boolean', 'doc': 'collapse the allowed ranges into the fewest CIDR blocks covering the same addresses (e.g. two adjacent /32 into a /31) before comparing them with the current rule. Defaults to False.'}
+}
+# Maximum number of values of a describe_security_groups filter.
+MAX_FILTER_VALUES = 200
 
 #######################################################################################################
 #
 #  update_security_group
 #
 #######################################################################################################
-@safe_kwargs({
-    'security_group_id': {'required': True, 'type': 'string', 'doc': 'the ID of the security group.'},
-    'comment': {'type': 'string', 'doc': 'rule\'s description.'},
-    'port': {'required': True, 'type': 'integer', 'doc': 'port for TCP and UDP protocols.'},
-    'protocol': {'required': True, 'type': 'string', 'doc': 'IP protocol name (tcp, udp, icmp, icmpv6) or -1 to specify all protocols.'},
-    'allowed_ipv4_addresses': {'required': True, 'type': 'list', 'schema': {'type': 'string', 'regex': IPV4_REGEX}, 'doc': 'IPv4 ranges. Use /32 to single IPv4 address.'},
-    'allowed_ipv6_addresses': {'required': True, 'type': 'list', 'schema': {'type': 'string', 'regex': IPV6_REGEX}, 'doc': 'IPv6 ranges. Use /128 to single IPv6 address.'}
-})
+@safe_kwargs(RULE_SCHEMA, engine='compiled')
 def update_security_group(**kwargs):
     """Update the rules of a security group.
 
@@ -43,33 +45,190 @@ def update_security_group(**kwargs):
     """    
     try:
         new_rule = kwargs
-        ec2 = boto3.resource('ec2')
-        security_group = ec2.SecurityGroup(new_rule['security_group_id'])
+        ec2 = get_client('ec2')
+        security_group_id = new_rule['security_group_id']
+        security_group = ec2.describe_security_groups(GroupIds=[security_group_id])['SecurityGroups'][0]
         port = new_rule['port']
         protocol = new_rule['protocol']
         current_rule = _get_rule(security_group, port, protocol)
 
-        new_rule['allowed_ipv4_addresses'] = [str(ipaddress.ip_network(ip)) for ip in new_rule['allowed_ipv4_addresses']]
-        new_rule['allowed_ipv6_addresses'] = [str(ipaddress.ip_network(ip)) for ip in new_rule['allowed_ipv6_addresses']]
+        new_rule.update(_allowed_addresses(new_rule, new_rule.get('aggregate', False)))
         
         revoking_addresses = _diff_addresses(current_rule, new_rule)
-        _set_rule('revoke', security_group, port, protocol, revoking_addresses)
+        _set_rule('revoke', ec2, security_group_id, port, protocol, revoking_addresses)
         
         authorizing_addresses = _diff_addresses(new_rule, current_rule)
-        _set_rule('authorize', security_group, port, protocol, authorizing_addresses)
+        _set_rule('authorize', ec2, security_group_id, port, protocol, authorizing_addresses)
+
+        return _report(port, protocol, revoking_addresses, authorizing_addresses)
+
+    except Exception as e:
+        raise e
+
+#######################################################################################################
+#
+#  update_security_groups
+#
+#######################################################################################################
+@safe_kwargs({
+    'rules': {'required': True, 'type': 'list', 'doc': 'desired state of each (security group, port, protocol). Keys:', 'schema': {'type': 'dict', 'schema': RULE_SCHEMA}},
+    'max_concurrency': {'type': 'integer', 'doc': 'number of security groups updated at the same time. Defaults to 4.'},
+    'aggregate': {'type': 'boolean', 'doc': 'default of the rules\' aggregate option. Defaults to False.'}
+}, engine='compiled')
+def update_security_groups(**kwargs):
+    """Update the rules of many security groups in one pass.
+
+    All the security groups are read with one paginated describe_security_groups call, then each
+    group is updated with at most one revoke_security_group_ingress and one
+    authorize_security_group_ingress call, for all of its ports and protocols.
+
+    Args:
+        **kwargs: keyword arguments. See below.
+
+    Keyword Args:
+        ${safe_kwargs}
+
+    Raises:
+        ValueError: in case of missing or invalid kwargs, duplicated rules or unknown security groups.
+            Nothing is changed in that case. If an update fails, the other groups are still updated
+            and the first error is raised: calling again with the same rules completes the update.
+
+    Returns:
+        A list with the result of each rule, in order, as returned by update_security_group.
+    """    
+    try:
+        ec2 = get_client('ec2')
+        aggregate = kwargs.get('aggregate', False)
+        rules = [dict(rule, **_allowed_addresses(rule, rule.get('aggregate', aggregate))) for rule in kwargs['rules']]
+
+        by_group = {}
+        for index, rule in enumerate(rules):
+            group_rules = by_group.setdefault(rule['security_group_id'], {})
+            if (rule['port'], rule['protocol']) in group_rules:
+                raise ValueError(f"duplicated rule: {rule['security_group_id']} {rule['protocol']} {rule['port']}")
+            group_rules[(rule['port'], rule['protocol'])] = index
+
+        security_groups = _describe_security_groups(ec2, list(by_group))
+        missing = [security_group_id for security_group_id in by_group if security_group_id not in security_groups]
+        if missing:
+            raise ValueError(f"security groups not found: {', '.join(missing)}")
+
+        reports = [None] * len(rules)
+        changes = {}
+        for security_group_id, group_rules in by_group.items():
+            revokes, authorizes = [], []
+            for (port, protocol), index in group_rules.items():
+                current_rule = _get_rule(security_groups[security_group_id], port, protocol)
+                revoking_addresses = _diff_addresses(current_rule, rules[index])
+                authorizing_addresses = _diff_addresses(rules[index], current_rule)
+                revokes += _ip_permissions(port, protocol, revoking_addresses)
+                authorizes += _ip_permissions(port, protocol, authorizing_addresses)
+                reports[index] = _report(port, protocol, revoking_addresses, authorizing_addresses)
+            if revokes or authorizes:
+                changes[security_group_id] = (revokes, authorizes)
 
-        return {
-            "port": port,
-            "protocol": protocol,
-            "revoked_ipv4_addresses": revoking_addresses['allowed_ipv4_addresses'],
-            "authorized_ipv4_addresses": authorizing_addresses['allowed_ipv4_addresses'],
-            "revoked_ipv6_addresses": revoking_addresses['allowed_ipv6_addresses'],
-            "authorized_ipv6_addresses": authorizing_addresses['allowed_ipv6_addresses']
-        }
+        with ThreadPoolExecutor(max_workers=max(1, kwargs.get('max_concurrency', 4))) as executor:
+            futures = [executor.submit(_update_ingress, ec2, security_group_id, *change) for security_group_id, change in changes.items()]
+        for future in futures:
+            future.result()
+
+        return reports
 
     except Exception as e:
         raise e
 
+#------------------------------------------------------------------------------------------------------
+#  _describe_security_groups
+#------------------------------------------------------------------------------------------------------
+def _describe_security_groups(ec2, security_group_ids):
+    security_groups = {}
+    paginator = ec2.get_paginator('describe_security_groups')
+
+    for start in range(0, len(security_group_ids), MAX_FILTER_VALUES):
+        filters = [{'Name': 'group-id', 'Values': security_group_ids[start:start + MAX_FILTER_VALUES]}]
+        for page in paginator.paginate(Filters=filters):
+            for security_group in page['SecurityGroups']:
+                security_groups[security_group['GroupId']] = security_group
+
+    return security_groups
+
+#------------------------------------------------------------------------------------------------------
+#  _update_ingress
+#------------------------------------------------------------------------------------------------------
+def _update_ingress(ec2, security_group_id, revokes, authorizes):
+    if revokes:
+        ec2.revoke_security_group_ingress(GroupId=security_group_id, IpPermissions=revokes)
+    if authorizes:
+        ec2.authorize_security_group_ingress(GroupId=security_group_id, IpPermissions=authorizes)
+
+#------------------------------------------------------------------------------------------------------
+#  _report
+#------------------------------------------------------------------------------------------------------
+def _report(port, protocol, revoking_addresses, authorizing_addresses):
+    return {
+        "port": port,
+        "protocol": protocol,
+        "revoked_ipv4_addresses": revoking_addresses['allowed_ipv4_addresses'],
+        "authorized_ipv4_addresses": authorizing_addresses['allowed_ipv4_addresses'],
+        "revoked_ipv6_addresses": revoking_addresses['allowed_ipv6_addresses'],
+        "authorized_ipv6_addresses": authorizing_addresses['allowed_ipv6_addresses']
+    }
+
+#------------------------------------------------------------------------------------------------------
+#  _allowed_addresses
+#------------------------------------------------------------------------------------------------------
+def _allowed_addresses(rule, aggregate):
+    ipv4_addresses = [normalize_network(ip, 4) for ip in rule['allowed_ipv4_addresses']]
+    ipv6_addresses = [normalize_network(ip, 6) for ip in rule['allowed_ipv6_addresses']]
+
+    return {
+        'allowed_ipv4_addresses': _collapse(ipv4_addresses, 4) if aggregate else ipv4_addresses,
+        'allowed_ipv6_addresses': _collapse(ipv6_addresses, 6) if aggregate else ipv6_addresses
+    }
+
+#------------------------------------------------------------------------------------------------------
+#  _collapse
+#------------------------------------------------------------------------------------------------------
+def _collapse(addresses, version):
+    # Same result as ipaddress.collapse_addresses() on normalized CIDR strings: the smallest sorted
+    # list of CIDR blocks covering the same addresses. Blocks are handled as integer ranges, which
+    # is an order of magnitude faster than with ipaddress objects on large allow-lists.
+    bits = 32 if version == 4 else 128
+    merged = []
+    for start, end in sorted(_address_range(ip, version) for ip in set(addresses)):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    blocks = []
+    for start, end in merged:
+        while start <= end:
+            # Largest block aligned on start that does not go beyond end.
+            size = min((start & -start).bit_length() - 1 if start else bits, (end - start + 1).bit_length() - 1)
+            blocks.append(_format_block(start, bits - size, version))
+            start += 1 << size
+    return blocks
+
+#------------------------------------------------------------------------------------------------------
+#  _address_range
+#------------------------------------------------------------------------------------------------------
+def _address_range(ip, version):
+    import socket
+    address, prefix = ip.split('/')
+    start = int.from_bytes(socket.inet_pton(socket.AF_INET if version == 4 else socket.AF_INET6, address), 'big')
+    return start, start + (1 << ((32 if version == 4 else 128) - int(prefix))) - 1
+
+#------------------------------------------------------------------------------------------------------
+#  _format_block
+#------------------------------------------------------------------------------------------------------
+def _format_block(start, prefix, version):
+    import ipaddress
+    import socket
+    if version == 4:
+        return f"{socket.inet_ntoa(start.to_bytes(4, 'big'))}/{prefix}"
+    return str(ipaddress.IPv6Network((start, prefix)))
+
 #------------------------------------------------------------------------------------------------------
 #  _diff_addresses
 #------------------------------------------------------------------------------------------------------
@@ -92,7 +251,7 @@ def _get_rule(security_group, port, protocol):
     allowed_ipv4_addresses = []
     allowed_ipv6_addresses = []
 
-    for ip_permission in security_group.ip_permissions:
+    for ip_permission in security_group.get('IpPermissions', []):
         if ip_permission.get('FromPort', None) == port and ip_permission.get('IpProtocol', None) == protocol:
             for ip_range in ip_permission.get('IpRanges', []):
                 allowed_ipv4_addresses.append(ip_range['CidrIp'])
@@ -108,25 +267,33 @@ def _get_rule(security_group, port, protocol):
 #------------------------------------------------------------------------------------------------------
 #  _set_rule
 #------------------------------------------------------------------------------------------------------
-def _set_rule(action, security_group, port, protocol, addresses):
+def _set_rule(action, ec2, security_group_id, port, protocol, addresses):
     try:
-        if len(addresses['allowed_ipv4_addresses']) == 0 and len(addresses['allowed_ipv6_addresses']) == 0:
+        ip_permissions = _ip_permissions(port, protocol, addresses)
+        if not ip_permissions:
             return
 
-        ip_permissions = [{
-            "FromPort": port,
-            "IpProtocol": protocol,
-            "IpRanges": [ {'CidrIp': ip} for ip in addresses['allowed_ipv4_addresses'] ],
-            "Ipv6Ranges": [ {'CidrIpv6': ip} for ip in addresses['allowed_ipv6_addresses'] ],
-            "PrefixListIds": [],
-            "ToPort": port,
-            "UserIdGroupPairs": []
-        }]
-
         if action == 'authorize':
-            security_group.authorize_ingress(IpPermissions=ip_permissions)
+            ec2.authorize_security_group_ingress(GroupId=security_group_id, IpPermissions=ip_permissions)
         elif action == 'revoke':
-            security_group.revoke_ingress(IpPermissions=ip_permissions)
+            ec2.revoke_security_group_ingress(GroupId=security_group_id, IpPermissions=ip_permissions)
 
     except Exception as e:
         raise e
+
+#------------------------------------------------------------------------------------------------------
+#  _ip_permissions
+#------------------------------------------------------------------------------------------------------
+def _ip_permissions(port, protocol, addresses):
+    if len(addresses['allowed_ipv4_addresses']) == 0 and len(addresses['allowed_ipv6_addresses']) == 0:
+        return []
+
+    return [{
+        "FromPort": port,
+        "IpProtocol": protocol,
+        "IpRanges": [ {'CidrIp': ip} for ip in addresses['allowed_ipv4_addresses'] ],
+        "Ipv6Ranges": [ {'CidrIpv6': ip} for ip in addresses['allowed_ipv6_addresses'] ],
+        "PrefixListIds": [],
+        "ToPort": port,
+        "UserIdGroupPairs": []
+    }]
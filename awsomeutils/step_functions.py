@@ -9,7 +9,7 @@ from .safe_kwargs import safe_kwargs
     'jobs': {'required': True, 'type': 'list', 'minlength': 1},
     'failed_jobs': {'type': 'list'},
     'processed_jobs': {'type': 'list'}
-})
+}, engine='compiled')
 def mark_as_failed(**kwargs):
     try:
         jobs = kwargs['jobs']
@@ -33,7 +33,7 @@ def mark_as_failed(**kwargs):
     'jobs': {'required': True, 'type': 'list', 'minlength': 1},
     'failed_jobs': {'type': 'list'},
     'processed_jobs': {'type': 'list'}
-})
+}, engine='compiled')
 def mark_as_processed(**kwargs):
     try:
         jobs = kwargs['jobs']
@@ -0,0 +1,81 @@
+import hashlib
+from string import Template
+from .cache import LRUCache
+
+# Compiled templates, keyed by ('text', content hash) by compile_template() and by
+# ('s3', bucket_name, file_key) by the s3 module, which revalidates them with their ETag.
+template_cache = LRUCache(max_entries=256, max_bytes=32 * 1024 * 1024)
+
+#######################################################################################################
+#
+#  CompiledTemplate
+#
+#######################################################################################################
+class CompiledTemplate:
+    """string.Template text split once into literal and placeholder segments.
+
+    substitute() has the semantics of string.Template.safe_substitute(): '$$' is an escaped '$',
+    placeholders missing from the mapping and invalid placeholders are left as they are. It only
+    fills the placeholder segments and joins them, without scanning the text again.
+
+    Args:
+        text: template text.
+    """
+    def __init__(self, text):
+        self._parts = []
+        self._slots = []
+        self._escapes = []
+        start = 0
+
+        for match in Template.pattern.finditer(text):
+            self._parts.append(text[start:match.start()])
+            name = match.group('named') or match.group('braced')
+            if name is not None:
+                self._slots.append((len(self._parts), name))
+                self._parts.append(match.group())
+            elif match.group('escaped') is not None:
+                self._escapes.append(len(self._parts))
+                self._parts.append(Template.delimiter)
+            else:
+                self._parts.append(match.group())
+            start = match.end()
+
+        self._parts.append(text[start:])
+        self.names = frozenset(name for _, name in self._slots)
+
+    @property
+    def text(self):
+        """The template text."""
+        parts = self._parts.copy()
+        for index in self._escapes:
+            parts[index] = Template.delimiter * 2
+        return ''.join(parts)
+
+    def substitute(self, mapping):
+        """Return the text with the placeholders found in mapping replaced by their values."""
+        parts = self._parts.copy()
+        for index, name in self._slots:
+            if name in mapping:
+                parts[index] = str(mapping[name])
+        return ''.join(parts)
+
+#######################################################################################################
+#
+#  compile_template
+#
+#######################################################################################################
+def compile_template(text):
+    """Return the CompiledTemplate of a text, from template_cache when the same text was compiled before.
+
+    Args:
+        text: template text.
+
+    Returns:
+        A CompiledTemplate.
+    """
+    key = ('text', hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest())
+    template = template_cache.get(key)
+    if template is None:
+        template = CompiledTemplate(text)
+        template_cache.put(key, template, size=len(text))
+    return template
@@ -0,0 +1,91 @@
+import copy
+import json
+import os
+import pickle
+import pytest
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+test_dir = os.path.dirname(__file__)
+package_dir = os.path.normpath(os.path.join(test_dir, '../'))
+sys.path.append(package_dir)
+from awsomeutils.cache import FrozenDict, FrozenList, LRUCache, freeze
+
+#######################################################################################################
+#
+#  TestLRUCache
+#
+#######################################################################################################
+class TestLRUCache:
+    def test_lru(self):
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+
+        cache.put('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert cache.pop('c') == 3
+        assert cache.stats() == {'entries': 1, 'bytes': 0, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.stats() == {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_entries=10, max_bytes=100)
+        cache.put('a', 1, size=40)
+        cache.put('b', 2, size=40)
+        cache.put('a', 3, size=50)
+        assert cache.stats()['bytes'] == 90
+
+        cache.put('c', 4, size=30)
+        assert cache.get('b') is None
+        assert cache.get('a') == 3
+        cache.put('d', 5, size=101)
+        assert cache.get('d') is None
+
+        assert cache.get('c', record=False) == 4
+        cache.record(True)
+        assert cache.stats() == {'entries': 2, 'bytes': 80, 'hits': 2, 'misses': 2, 'evictions': 1}
+
+    def test_concurrent_access(self):
+        cache = LRUCache(max_entries=10)
+        def access(i):
+            cache.put(i % 20, i)
+            cache.get((i + 1) % 20)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(access, range(1000)))
+
+        stats = cache.stats()
+        assert stats['entries'] == 10
+        assert stats['hits'] + stats['misses'] == 1000
+
+#######################################################################################################
+#
+#  TestFreeze
+#
+#######################################################################################################
+class TestFreeze:
+    def test_freeze(self):
+        data = {'a': [1, {'b': 2}], 'c': 'd'}
+        frozen = freeze(data)
+        assert frozen == data
+        assert isinstance(frozen, FrozenDict) and isinstance(frozen['a'], FrozenList) and isinstance(frozen['a'][1], FrozenDict)
+        assert json.loads(json.dumps(frozen)) == data
+
+        with pytest.raises(TypeError):
+            frozen['c'] = 'e'
+        with pytest.raises(TypeError):
+            frozen['a'].append(3)
+        with pytest.raises(TypeError):
+            frozen['a'][1].update(b=3)
+
+        copied = copy.deepcopy(frozen)
+        copied['a'][1]['b'] = 3
+        assert type(copied) is dict and type(copied['a']) is list
+        assert frozen['a'][1]['b'] == 2
+        assert pickle.loads(pickle.dumps(frozen)) == data
@@ -0,0 +1,61 @@
+import boto3
+import os
+import pytest
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from moto import mock_s3
+
+os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+
+test_dir = os.path.dirname(__file__)
+package_dir = os.path.normpath(os.path.join(test_dir, '../'))
+sys.path.append(package_dir)
+from awsomeutils import clients
+from awsomeutils.s3 import list_files
+
+#######################################################################################################
+#
+#  TestGetClient
+#
+#######################################################################################################
+class TestGetClient:
+    def setup_method(self):
+        clients.reset()
+
+    def teardown_method(self):
+        clients.reset()
+
+    def test_shared_client(self):
+        s3 = clients.get_client('s3')
+        assert clients.get_client('s3') is s3
+        assert clients.get_client('ec2') is not s3
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            assert set(map(id, executor.map(clients.get_client, ['sqs'] * 32))) == {id(clients.get_client('sqs'))}
+
+    def test_configure(self):
+        with pytest.raises(ValueError):
+            clients.configure(retry_mode='foo')
+
+        s3 = clients.get_client('s3')
+        config = clients.configure(region_name='sa-east-1', max_pool_connections=7, max_attempts=2)
+        assert config == {'region_name': 'sa-east-1', 'max_pool_connections': 7, 'retry_mode': 'standard', 'max_attempts': 2}
+
+        new_s3 = clients.get_client('s3')
+        assert new_s3 is not s3
+        assert new_s3.meta.region_name == 'sa-east-1'
+        assert new_s3.meta.config.max_pool_connections == 7
+        assert new_s3.meta.config.retries == {'mode': 'standard', 'total_max_attempts': 2}
+
+    @mock_s3
+    def test_set_client(self):
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        s3.put_object(Bucket='test', Key='path/file', Body='')
+
+        clients.set_client('s3', s3)
+        assert clients.get_client('s3') is s3
+        assert list_files(bucket_name='test', path='path') == [{'file_name': 'path/file'}]
+
+        clients.set_client('s3', None)
+        assert clients.get_client('s3') is not s3
@@ -1,16 +1,28 @@
+import base64
+import boto3
 import smtplib
 import os
+import time
 import pytest
+import socket
+import socketserver
 import sys
+import tempfile
+import threading
+from botocore.config import Config
 from minimock import Mock
+from moto import mock_s3
 
 smtplib.SMTP_SSL = Mock('smtplib.SMTP_SSL')
 smtplib.SMTP_SSL.mock_returns = Mock('smtp_server')
 
+os.environ['AWS_DEFAULT_REGION'] = "us-east-1"
+
 test_dir = os.path.dirname(__file__)
 package_dir = os.path.normpath(os.path.join(test_dir, '../'))
 sys.path.append(package_dir)
-from awsomeutils import email
+from awsomeutils import clients, email
+from awsomeutils.email import SMTPPool
 
 #######################################################################################################
 #
@@ -44,3 +56,501 @@ class TestEmail:
 
     def test_send(self):
         assert email.send(**event)['status_code'] == 200
+
+#######################################################################################################
+#
+#  class TestSMTPPool
+#
+#######################################################################################################
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Local plain SMTP server recording connections, logins and messages."""
+    daemon_threads = True
+    allow_reuse_address = True
+    keep_messages = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.connections = []
+        self.logins = []
+        self.messages = []
+        self.commands = []
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    def drop_connections(self):
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections.append(self.request)
+        self.reply('220 localhost stand-in')
+        for line in self.rfile:
+            command = line.decode('ascii').strip()
+            verb = command.split(' ')[0].upper()
+            self.server.commands.append(verb)
+            if verb == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 AUTH PLAIN')
+            elif verb == 'AUTH':
+                self.server.logins.append(command)
+                if base64.b64decode(command.split(' ')[-1]).endswith(b'\0wrong'):
+                    self.reply('535 Authentication failed')
+                else:
+                    self.reply('235 Authentication successful')
+            elif verb == 'RCPT' and 'refused' in command:
+                self.reply('550 No such user')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data, size = [], 0
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    line = line[1:] if line.startswith(b'..') else line
+                    size += len(line)
+                    if self.server.keep_messages:
+                        data.append(line)
+                else:
+                    # Connection closed before the end of the message.
+                    return
+                self.server.messages.append(b''.join(data) if self.server.keep_messages else size)
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+@pytest.fixture
+def smtp_server(request, monkeypatch):
+    # The stand-in server speaks plain SMTP, without TLS.
+    monkeypatch.setattr(smtplib, 'SMTP_SSL', smtplib.SMTP)
+    pool = SMTPPool()
+    monkeypatch.setattr(email, 'smtp_pool', pool)
+    server = SMTPStandIn()
+    request.instance.server = server
+    request.instance.pool = pool
+    request.instance.credentials = {'host': '127.0.0.1', 'port': server.server_address[1], 'user': 'user', 'password': 'passwd'}
+    request.instance.event = dict(event, **request.instance.credentials)
+    yield server
+    pool.close_all()
+    server.shutdown()
+    server.server_close()
+
+@pytest.mark.usefixtures('smtp_server')
+class TestSMTPPool:
+    def test_reuse(self):
+        for i in range(3):
+            assert email.send(**self.event)['status_code'] == 200
+
+        assert len(self.server.connections) == 1 and len(self.server.logins) == 1 and len(self.server.messages) == 3
+        assert self.pool.stats() == {'idle': 1, 'connects': 1, 'reuses': 2, 'closes': 0}
+
+        email.send(**dict(self.event, password='other'))
+        assert len(self.server.logins) == 2
+
+    def test_reconnect(self, monkeypatch):
+        checks = []
+        is_alive = email._is_alive
+        monkeypatch.setattr(email, '_is_alive', lambda server: checks.append(is_alive(server)) or checks[-1])
+
+        # Dropped while fresh: sendmail fails with SMTPServerDisconnected and is sent again.
+        email.send(**self.event)
+        self.server.drop_connections()
+        email.send(**self.event)
+        assert checks == []
+        assert len(self.server.connections) == 2 and len(self.server.messages) == 2
+
+        # Dropped after check_interval: NOOP fails and a new connection is opened before sending.
+        self.pool.check_interval = 0
+        email.send(**self.event)
+        self.server.drop_connections()
+        email.send(**self.event)
+        assert checks == [True, False]
+        assert len(self.server.connections) == 3 and len(self.server.messages) == 4
+
+    def test_reconnect_refused(self, monkeypatch):
+        email.send(**self.event)
+        self.server.drop_connections()
+        monkeypatch.setattr(self.pool, 'connect', Mock('connect', raises=ConnectionRefusedError()))
+
+        # The dropped connection is discarded once, not again when reconnecting fails.
+        with pytest.raises(ConnectionRefusedError):
+            email.send(**self.event)
+        assert self.pool.stats()['closes'] == 1
+
+    def test_shared_rules(self):
+        # A refused message leaves the connection in the pool, whatever the sender.
+        with pytest.raises(smtplib.SMTPRecipientsRefused):
+            email.send(**dict(self.event, message=dict(event['message'], email='refused@test.com')))
+        assert self.pool.stats()['closes'] == 0 and self.pool.stats()['idle'] == 1
+
+        # A dropped connection is replaced and the message sent again, whatever the sender.
+        senders = [
+            lambda: email.send_many(messages=[event['message']], **self.credentials),
+            lambda: email.send_merge(subject='Hi', body='Hi', recipients=[{'email': 'test@test.com'}], **self.credentials)
+        ]
+        for sender in senders:
+            self.server.drop_connections()
+            sender()
+        assert len(self.server.messages) == 2 and len(self.server.connections) == 3
+        assert self.pool.stats()['closes'] == 2
+
+    def test_idle_timeout(self):
+        email.send(**self.event)
+        self.pool.idle_timeout = 0
+        email.send(**self.event)
+        assert self.server.commands.count('QUIT') == 1
+        assert len(self.server.connections) == 2
+
+    def test_send_many(self):
+        messages = [dict(event['message'], email=f"user{i}@test.com") for i in range(50)]
+        statuses = email.send_many(messages=messages, **self.credentials,
+                                   max_connections=3, max_messages_per_connection=10)
+
+        assert statuses == [{'status_code': 200}] * 50
+        assert len(self.server.messages) == 50
+        assert 5 <= len(self.server.connections) <= 7
+        assert len(self.server.logins) == len(self.server.connections)
+
+    def test_send_many_errors(self):
+        messages = [event['message'], dict(event['message'], email='refused@test.com'), dict(event['message'], email='invalid'), event['message']]
+        statuses = email.send_many(messages=messages, **self.credentials, max_connections=1)
+
+        assert [status['status_code'] for status in statuses] == [200, 550, 400, 200]
+        assert statuses[1]['error'] == 'No such user'
+        assert len(self.server.messages) == 2 and len(self.server.connections) == 1
+
+        statuses = email.send_many(messages=messages, **dict(self.credentials, password='wrong'))
+        assert [status['status_code'] for status in statuses] == [503, 503, 400, 503]
+
+        # Keys that are not strings are an invalid message too, and the connection goes back to the pool.
+        statuses = email.send_many(messages=[event['message'], {1: 'x'}], **self.credentials, max_connections=1)
+        assert [status['status_code'] for status in statuses] == [200, 400]
+        assert self.pool.stats()['idle'] == 1
+
+        with pytest.raises(ValueError):
+            email.send_many(messages=[1], **self.credentials)
+
+    @pytest.mark.benchmark
+    def test_throughput(self):
+        messages = [event['message']] * 200
+
+        self.pool.max_idle = 0
+        start = time.perf_counter()
+        for message in messages:
+            email.send(message=message, **self.credentials)
+        sequential = time.perf_counter() - start
+
+        self.pool.max_idle = 4
+        start = time.perf_counter()
+        assert email.send_many(messages=messages, **self.credentials) == [{'status_code': 200}] * 200
+        batch = time.perf_counter() - start
+
+        print(f"send, one connection per message: {len(messages) / sequential:.0f} msg/s")
+        print(f"send_many, 4 connections: {len(messages) / batch:.0f} msg/s")
+        assert len(self.server.messages) == 400
+
+#######################################################################################################
+#
+#  class TestOutbox
+#
+#######################################################################################################
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+class TestOutbox:
+    @pytest.fixture(autouse=True)
+    def local_outbox(self, smtp_server, monkeypatch, tmp_path):
+        self.path = str(tmp_path / 'outbox.sqlite3')
+        self.outbox = email.Outbox(path=self.path, backoff=0)
+        monkeypatch.setattr(email, 'outbox', self.outbox)
+        yield
+        self.outbox.close()
+
+    def test_send(self):
+        responses = [email.send(**self.event, outbox=True) for i in range(5)]
+        assert [response['status_code'] for response in responses] == [202] * 5
+        assert [response['id'] for response in responses] == [1, 2, 3, 4, 5]
+
+        wait_for(lambda: self.outbox.stats()['pending'] == 0)
+        assert len(self.server.messages) == 5
+        stats = self.outbox.stats()
+        assert (stats['pending'], stats['dead'], stats['lag'], stats['sent']) == (0, 0, 0.0, 5)
+        assert stats['last_flush'] is not None
+
+        with pytest.raises(ValueError):
+            email.send(**dict(self.event, outbox='yes'))
+
+    def test_dead_letters(self):
+        self.outbox.max_attempts = 2
+        email.send(**dict(self.event, message=dict(event['message'], email='refused@test.com')), outbox=True)
+        wait_for(lambda: self.outbox.stats()['dead'] == 1)
+
+        # A failed login is retried, until max_attempts.
+        email.send(**dict(self.event, password='wrong'), outbox=True)
+        wait_for(lambda: self.outbox.stats()['dead'] == 2)
+
+        refused, unauthorized = self.outbox.dead_letters()
+        assert refused['message']['email'] == 'refused@test.com'
+        assert (refused['attempts'], refused['error']) == (1, '550 No such user')
+        assert unauthorized['attempts'] == 2 and unauthorized['error'].startswith('535')
+        assert self.outbox.stats()['retries'] == 1 and self.server.messages == []
+
+    def test_shared_file(self, monkeypatch, tmp_path):
+        # The default file is resolved on first use, so TMPDIR may be set after the import.
+        monkeypatch.setenv('TMPDIR', str(tmp_path))
+        monkeypatch.setattr(tempfile, 'tempdir', None)
+        default = email.Outbox()
+        assert default.path is None and default.stats()['pending'] == 0
+        assert default.path == str(tmp_path / 'awsomeutils-outbox.sqlite3')
+
+        # Outboxes of two processes sharing the file claim their batches: each message is sent once.
+        others = [email.Outbox(path=self.path, batch_size=5) for i in range(2)]
+        for other in others:
+            other._run = lambda: None
+        for i in range(40):
+            others[i % 2].enqueue(self.event['host'], self.event['port'], self.event['user'], self.event['password'], event['message'])
+        threads = [threading.Thread(target=other.flush) for other in others]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(self.server.messages) == 40
+        assert sum(other.stats()['sent'] for other in others) == 40
+
+        # A batch left claimed by a process that stopped is sent again once its lease has expired.
+        batch = others[0].enqueue(self.event['host'], self.event['port'], self.event['user'], self.event['password'], event['message'])
+        with others[0]._connection() as db:
+            db.execute("UPDATE outbox SET state = 'sending', claim = 'stopped', next_attempt = ? WHERE id = ?", (time.time() + 60, batch))
+        assert others[1].flush() == 0
+        with others[0]._connection() as db:
+            db.execute('UPDATE outbox SET next_attempt = 0 WHERE id = ?', (batch,))
+        assert others[1].flush() == 1
+
+    def test_reconnect(self):
+        email.send(**self.event, outbox=True)
+        wait_for(lambda: len(self.server.messages) == 1)
+
+        # A pooled connection closed by the server is replaced at once, without waiting for a retry.
+        self.server.drop_connections()
+        email.send(**self.event, outbox=True)
+        wait_for(lambda: self.outbox.stats()['pending'] == 0)
+        assert len(self.server.messages) == 2 and len(self.server.connections) == 2
+        assert self.outbox.stats()['retries'] == 0
+
+    def test_restart(self):
+        stopped = email.Outbox(path=self.path)
+        stopped._run = lambda: None
+        for i in range(3):
+            stopped.enqueue(self.event['host'], self.event['port'], self.event['user'], self.event['password'], event['message'])
+
+        # Passwords are not spooled: the messages wait until the user sends again.
+        assert self.outbox.stats()['pending'] == 3
+        assert self.outbox.flush() == 0
+        email.send(**self.event, outbox=True)
+        wait_for(lambda: self.outbox.stats()['pending'] == 0)
+        assert len(self.server.messages) == 4
+
+    @pytest.mark.benchmark
+    def test_latency(self):
+        email.send(message=event['message'], **self.credentials)
+
+        start = time.perf_counter()
+        for i in range(50):
+            email.send(message=event['message'], **self.credentials)
+        direct = (time.perf_counter() - start) / 50
+
+        start = time.perf_counter()
+        for i in range(50):
+            email.send(message=event['message'], outbox=True, **self.credentials)
+        spooled = (time.perf_counter() - start) / 50
+
+        wait_for(lambda: self.outbox.stats()['pending'] == 0)
+        print(f"send: {direct * 1000:.2f} ms per message, send with outbox: {spooled * 1000:.2f} ms per message")
+        assert len(self.server.messages) == 101
+
+#######################################################################################################
+#
+#  class TestMailMerge
+#
+#######################################################################################################
+@pytest.mark.usefixtures('smtp_server')
+class TestMailMerge:
+    def test_render(self):
+        from email import message_from_string, policy
+        random = __import__('random').Random(22)
+        characters = 'abcdefghij XYZ.,\n\r\tçã'
+        for i in range(300):
+            subject = ''.join(random.choice('abc XYZ áé') for _ in range(random.randint(0, 90)))
+            body = ''.join(random.choice(characters) for _ in range(random.randint(0, 300)))
+            rendered = email.MailTemplate('$subject', '${body}').render({'subject': subject, 'body': body})
+            expected = email._build_message(subject, body).as_string()
+
+            if body.isascii() and subject.isascii() and len(subject) < 60:
+                assert rendered == expected
+            parsed, built = (message_from_string(text, policy=policy.default) for text in (rendered, expected))
+            assert (parsed['Subject'], parsed.get_content()) == (built['Subject'], built.get_content())
+
+        with pytest.raises(ValueError):
+            email.MailTemplate('Hello $name', '').render({'name': 'Ana\nBcc: x@test.com'})
+
+    def test_send_merge(self):
+        def recipients():
+            yield {'email': 'ana@test.com', 'name': 'Ana', 'code': 1}
+            yield {'email': 'invalid', 'name': 'Nobody'}
+            yield {'email': 'refused@test.com', 'name': 'Refused'}
+            yield {'email': 'bia@test.com', 'name': 'Bia', 'code': 2}
+
+        result = email.send_merge(subject='Hello $name', body='Dear $name,\nyour code is ${code}.', recipients=recipients(), **self.credentials)
+        assert result['sent'] == 2 and sorted(result['errors']) == [1, 2]
+        assert result['errors'][2] == '550 No such user'
+        assert len(self.server.connections) == 1
+        assert [message.split(b'\r\n\r\n')[1] for message in self.server.messages] == [b'Dear Ana,\r\nyour code is 1.\r\n', b'Dear Bia,\r\nyour code is 2.\r\n']
+
+        result = email.send_merge(subject='Hi', body='Hi', recipients=recipients(), **dict(self.credentials, password='wrong'))
+        assert result['sent'] == 0 and list(result['errors']) == [0]
+
+        with pytest.raises(ValueError):
+            email.send_merge(subject='Hi', body='Hi', recipients='ana@test.com', **self.credentials)
+
+    @pytest.mark.benchmark
+    def test_render_scaling(self):
+        import tracemalloc
+        template = email.MailTemplate('Hello $name', 'Dear $name,\nyour code is ${code}.\n' * 10)
+        timings = {}
+        for count in (10000, 100000):
+            start = time.perf_counter()
+            for i in range(count):
+                template.render({'name': 'Ana', 'code': i})
+            timings[count] = time.perf_counter() - start
+
+        peaks = {}
+        for count in (1000, 10000):
+            tracemalloc.start()
+            for i in range(count):
+                template.render({'name': 'Ana', 'code': i})
+            peaks[count] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        start = time.perf_counter()
+        for i in range(2000):
+            email._build_message('Hello Ana', f"Dear Ana,\nyour code is {i}.\n" * 10).as_string()
+        built = time.perf_counter() - start
+
+        print(f"MailTemplate.render: {100000 / timings[100000]:.0f} msg/s, _build_message: {2000 / built:.0f} msg/s")
+        print(f"peak memory: {peaks[1000]} bytes for 1k messages, {peaks[10000]} bytes for 10k")
+        assert peaks[10000] < 2 * peaks[1000] + 64 * 1024
+        assert timings[100000] < 20 * timings[10000]
+
+#######################################################################################################
+#
+#  class TestAttachments
+#
+#######################################################################################################
+class GeneratedBody:
+    """S3 object body generated on the fly, to send large attachments without holding them in memory."""
+    def __init__(self, size):
+        self.size = size
+
+    def iter_chunks(self, chunk_size):
+        for start in range(0, self.size, chunk_size):
+            yield bytes([start // chunk_size % 256]) * min(chunk_size, self.size - start)
+
+@mock_s3
+@pytest.mark.usefixtures('smtp_server')
+class TestAttachments:
+    def setup_method(self, method):
+        self.s3 = boto3.client('s3', config=Config(request_checksum_calculation='when_required'))
+        self.s3.create_bucket(Bucket='test')
+        clients.set_client('s3', self.s3)
+
+    def teardown_method(self, method):
+        clients.reset()
+
+    def test_attachments(self):
+        from email import message_from_bytes, policy
+        files = {
+            'reports/report.csv': b'id,value\n1,2\n',
+            'reports/data.bin': os.urandom(3 * email.ATTACHMENT_CHUNK_SIZE + 1000),
+            'reports/empty.txt': b''
+        }
+        for key, body in files.items():
+            self.s3.put_object(Bucket='test', Key=key, Body=body)
+
+        message = dict(event['message'], body='Reports attached.\n.hidden line')
+        attachments = [{'bucket_name': 'test', 'file_key': key} for key in files]
+        attachments[1].update(file_name='relatório.bin', content_type='application/x-test')
+        assert email.send(message=message, attachments=attachments, **self.credentials)['status_code'] == 200
+
+        mail = message_from_bytes(self.server.messages[0], policy=policy.default)
+        assert mail['Subject'] == 'Lorem Ipsum' and mail.get_content_type() == 'multipart/mixed'
+        text, *parts = mail.iter_parts()
+        assert text.get_content().replace('\r\n', '\n') == 'Reports attached.\n.hidden line\n'
+        assert [part.get_filename() for part in parts] == ['report.csv', 'relatório.bin', 'empty.txt']
+        assert [part.get_content_type() for part in parts] == ['text/csv', 'application/x-test', 'text/plain']
+        assert [part.get_payload(decode=True) for part in parts] == list(files.values())
+        assert max(len(line) for line in self.server.messages[0].split(b'\r\n')) <= 78
+
+    def test_missing_attachment(self):
+        attachments = [{'bucket_name': 'test', 'file_key': 'missing.csv'}]
+        with pytest.raises(Exception):
+            email.send(message=event['message'], attachments=attachments, **self.credentials)
+
+        # The message is aborted by closing the connection, the next one opens a new connection.
+        assert email.send(message=event['message'], **self.credentials)['status_code'] == 200
+        assert len(self.server.messages) == 1 and len(self.server.connections) == 2
+
+        with pytest.raises(ValueError):
+            email.send(message=event['message'], attachments=[{'file_key': 'missing.csv'}], **self.credentials)
+
+    def test_prefetch(self):
+        produced = []
+        def items():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        # The thread holds at most one item besides the queue, however slow the consumer is.
+        prefetch = email._Prefetch(items(), 4)
+        for consumed, item in enumerate(prefetch, 1):
+            time.sleep(0.01)
+            assert item == consumed - 1 and len(produced) <= consumed + 4 + 1
+            if consumed == 10:
+                break
+
+        prefetch.close()
+        time.sleep(0.3)
+        assert len(produced) <= 10 + 4 + 1
+        assert list(email._Prefetch(iter(range(100)), 4)) == list(range(100))
+
+        with pytest.raises(ZeroDivisionError):
+            list(email._Prefetch((1 / i for i in (1, 0)), 4))
+
+    @pytest.mark.benchmark
+    def test_memory(self, monkeypatch):
+        import tracemalloc
+        size = 16 * 1024 * 1024
+        get_object = lambda **kwargs: {'Body': GeneratedBody(size)}
+        monkeypatch.setattr(self.s3, 'get_object', get_object)
+        self.server.keep_messages = False
+        attachments = [{'bucket_name': 'test', 'file_key': 'large.bin'}]
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        email.send(message=event['message'], attachments=attachments, **self.credentials)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f"16 MB attachment: {elapsed:.2f} s, peak memory {peak / 1024 / 1024:.1f} MB")
+        assert self.server.messages[0] > size * 4 / 3
+        assert peak < 8 * 1024 * 1024
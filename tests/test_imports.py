@@ -0,0 +1,32 @@
+import os
+import pytest
+import subprocess
+import sys
+
+test_dir = os.path.dirname(__file__)
+package_dir = os.path.normpath(os.path.join(test_dir, '../'))
+
+HEAVY_MODULES = ['boto3', 'botocore', 'cerberus', 'smtplib', 'email.message']
+
+def loaded_modules(statement):
+    # Run in a fresh interpreter, so modules imported by other tests do not count.
+    script = f"{statement}; import sys; print('\\n'.join(sys.modules))"
+    result = subprocess.run([sys.executable, '-c', script], cwd=package_dir, capture_output=True, text=True, check=True)
+    return set(result.stdout.splitlines())
+
+#######################################################################################################
+#
+#  TestColdImport
+#
+#######################################################################################################
+class TestColdImport:
+    @pytest.mark.parametrize('module', ['cache', 'clients', 'email', 's3', 'safe_kwargs', 'security_group', 'step_functions', 'template'])
+    def test_import(self, module):
+        modules = loaded_modules(f"import awsomeutils.{module}")
+
+        assert f"awsomeutils.{module}" in modules
+        assert [heavy for heavy in HEAVY_MODULES if heavy in modules] == []
+
+    def test_step_functions_call(self):
+        modules = loaded_modules('from awsomeutils.step_functions import mark_as_processed; mark_as_processed(jobs=[1])')
+        assert [heavy for heavy in HEAVY_MODULES if heavy in modules] == []
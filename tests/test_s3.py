@@ -1,16 +1,26 @@
 import boto3
+import bz2
+import gzip
 import json
+import lzma
 import os
 import pytest
+import random
 import sys
+import time
+from botocore.config import Config
+from botocore.exceptions import ConnectionClosedError
 from moto import mock_s3
+from string import Template
 
 os.environ['AWS_DEFAULT_REGION'] = "us-east-1"
 
 test_dir = os.path.dirname(__file__)
 package_dir = os.path.normpath(os.path.join(test_dir, '../'))
 sys.path.append(package_dir)
-from awsomeutils.s3 import list_files, populate_template, read_json_file
+from awsomeutils import clients, s3 as s3_module
+from awsomeutils.template import template_cache
+from awsomeutils.s3 import iter_files, iter_json_array, iter_json_lines, json_cache, list_files, listing_cache, populate_template, populate_templates, read_file, read_json_file, read_json_files, walk_files, write_file
 
 #######################################################################################################
 #
@@ -62,6 +72,129 @@ class TestListFiles:
         assert list_3[1]['file_name'] == files[4]['key']
         assert list_3[2]['file_name'] == files[5]['key']
 
+        assert list_files(bucket_name='test', path='empty') == []
+
+    def test_list_files_pages(self):
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        keys = [f"pages/file{i:04}" for i in range(1010)]
+        for key in keys + ['pages/nested/file', 'pages/nested/deeper/file']:
+            s3.put_object(Bucket='test', Key=key, Body='')
+
+        assert [file['file_name'] for file in list_files(bucket_name='test', path='pages')] == keys
+
+    def test_list_files_cache(self):
+        listing_cache.clear()
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        for file in files:
+            s3.put_object(Bucket='test', Key=file['key'], Body=file['body'])
+
+        requests = []
+        def record_request(params, **kwargs):
+            requests.append(params)
+        clients.get_client('s3').meta.events.register('before-parameter-build.s3.ListObjectsV2', record_request)
+
+        try:
+            event = {'bucket_name': 'test', 'path': 'path/to', 'cache_ttl': 60}
+            assert list_files(**event) == [{'file_name': files[1]['key']}, {'file_name': files[2]['key']}]
+            assert 'StartAfter' not in requests[-1]
+
+            s3.put_object(Bucket='test', Key='path/to/file2.3', Body='file 2.3')
+            s3.delete_object(Bucket='test', Key=files[1]['key'])
+            assert list_files(**event)[-1] == {'file_name': 'path/to/file2.3'}
+            assert requests[-1]['StartAfter'] == files[2]['key']
+            assert len(list_files(**event)) == 3
+
+            assert list_files(full_refresh=True, **event) == [{'file_name': files[2]['key']}, {'file_name': 'path/to/file2.3'}]
+            assert 'StartAfter' not in requests[-1]
+
+            assert len(list_files(bucket_name='test', path='path/to')) == 2
+            assert listing_cache.stats()['hits'] == 2
+        finally:
+            clients.get_client('s3').meta.events.unregister('before-parameter-build.s3.ListObjectsV2', record_request)
+
+#######################################################################################################
+#
+#  TestIterFiles
+#
+#######################################################################################################
+@mock_s3
+class TestIterFiles:
+    def test_iter_files(self):
+        with pytest.raises(ValueError):
+            iter_files(bucket_name='test', path='path/')
+
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        for file in files:
+            s3.put_object(Bucket='test', Key=file['key'], Body=file['body'])
+
+        iterator = iter_files(bucket_name='test', path='path/to')
+        assert next(iterator) == {'file_name': files[1]['key']}
+        assert list(iterator) == [{'file_name': files[2]['key']}]
+
+#######################################################################################################
+#
+#  TestWalkFiles
+#
+#######################################################################################################
+partitioned_keys = sorted(
+    [f"data/{year}/{month:02}/{day:02}/part-{part}.csv" for year in (2021, 2022) for month in (1, 2, 11) for day in (1, 9, 10) for part in (0, 1)] +
+    ['data/manifest.json', 'data/2022/_SUCCESS', 'data/2022-backup.csv']
+)
+
+@mock_s3
+class TestWalkFiles:
+    def test_walk_files(self):
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        for key in partitioned_keys + ['other/file.csv']:
+            s3.put_object(Bucket='test', Key=key, Body='')
+
+        with pytest.raises(ValueError):
+            walk_files(bucket_name='test', path='data', max_workers='4')
+
+        ordered = [file['file_name'] for file in walk_files(bucket_name='test', path='data', max_workers=4, ordered=True)]
+        assert ordered == partitioned_keys
+
+        unordered = [file['file_name'] for file in walk_files(bucket_name='test', path='data')]
+        assert sorted(unordered) == partitioned_keys
+
+    def test_walk_files_close(self):
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        for key in partitioned_keys:
+            s3.put_object(Bucket='test', Key=key, Body='')
+
+        walk = walk_files(bucket_name='test', path='data', max_workers=2, ordered=True)
+        assert [next(walk)['file_name'] for i in range(3)] == partitioned_keys[:3]
+        walk.close()
+
+    @pytest.mark.parametrize('ordered', [True, False])
+    def test_walk_files_backpressure(self, ordered):
+        s3 = clients.get_client('s3')
+        s3.create_bucket(Bucket='test')
+        keys = sorted(f"data/{i:02}/{j:02}/file.csv" for i in range(10) for j in range(10))
+        for key in keys:
+            s3.put_object(Bucket='test', Key=key, Body='')
+        listings = []
+        record = lambda params, **kwargs: listings.append(params['Prefix'])
+        s3.meta.events.register('before-parameter-build.s3.ListObjectsV2', record)
+
+        # A consumer that stops after 3 keys: besides the listings needed to reach them (the root, its
+        # 10 sub-paths and 3 leaves), at most 2 * max_workers are listed ahead, out of 111.
+        walk = walk_files(bucket_name='test', path='data', max_workers=2, ordered=ordered)
+        first = [next(walk)['file_name'] for i in range(3)]
+        time.sleep(0.2)
+        assert len(listings) <= 1 + 10 + 3 + 2 * 2
+        walk.close()
+
+        assert first == keys[:3] if ordered else set(first) <= set(keys)
+        walked = [file['file_name'] for file in walk_files(bucket_name='test', path='data', max_workers=2, ordered=ordered)]
+        assert (walked if ordered else sorted(walked)) == keys
+        s3.meta.events.unregister('before-parameter-build.s3.ListObjectsV2', record)
+
 #######################################################################################################
 #
 #  TestPopulateTemplate
@@ -153,6 +286,177 @@ class TestPopulateTemplate:
         assert populate_template(**event) == 'tmp/input.txt'
         assert s3.Object('test', 'tmp/input.txt').get()['Body'].read().decode('utf-8') == output      
 
+    def test_template_cache(self):
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        s3.put_object(Bucket='test', Key='input.txt', Body=input)
+        clients.set_client('s3', s3)
+        template_cache.clear()
+        event = {
+            'input_type': 'file',
+            'input_file': 'input.txt',
+            'substitutions': substitutions,
+            'output_type': 'text',
+            'bucket_name': 'test'
+        }
+        try:
+            for i in range(3):
+                assert populate_template(**event) == output
+            assert template_cache.stats()['hits'] == 2 and template_cache.stats()['misses'] == 1
+
+            s3.put_object(Bucket='test', Key='input.txt', Body='changed $foo')
+            assert populate_template(**event, cache_ttl=60) == output
+            assert populate_template(**event) == 'changed Lorem'
+            assert template_cache.stats()['misses'] == 2
+        finally:
+            clients.reset()
+            template_cache.clear()
+
+#######################################################################################################
+#
+#  TestStreamTemplate
+#
+#######################################################################################################
+@pytest.fixture
+def transfer_bucket(request):
+    # moto does not decode multi-chunk aws-chunked bodies, sent by default for large uploads, and keeps
+    # 'aws-chunked' in ContentEncoding, which S3 strips: only send checksums when an operation requires them.
+    with mock_s3():
+        s3 = boto3.client('s3', config=Config(request_checksum_calculation='when_required'))
+        s3.create_bucket(Bucket='test')
+        clients.set_client('s3', s3)
+        s3_module.configure_transfers(threshold=s3_module.MIN_PART_SIZE, part_size=s3_module.MIN_PART_SIZE, max_concurrency=4)
+        request.instance.s3 = s3
+        yield s3
+        s3_module.configure_transfers(**s3_module.DEFAULT_TRANSFER_CONFIG)
+        clients.reset()
+
+@pytest.mark.usefixtures('transfer_bucket')
+class TestStreamTemplate:
+    def populate(self, text, substitutions, **kwargs):
+        self.s3.put_object(Bucket='test', Key='input.txt', Body=text.encode('utf-8'))
+        output_file = populate_template(input_type='file', input_file='input.txt', substitutions=substitutions,
+                                        output_type='file', output_file='output.txt', bucket_name='test', stream=True, **kwargs)
+        return output_file, self.s3.get_object(Bucket='test', Key=output_file)['Body'].read().decode('utf-8')
+
+    def test_stream_kwargs(self):
+        with pytest.raises(ValueError):
+            populate_template(input_type='text', input_text=input, substitutions=substitutions, output_type='text', stream=True)
+
+    def test_chunk_boundaries(self, monkeypatch):
+        rng = random.Random(7)
+        tokens = ['$', '$$', '{', '}', 'foo', 'bar', 'foobar', ' ', '\n', 'é', '✓', '${foo}', '$bar']
+        text = ''.join(rng.choice(tokens) for i in range(3000))
+        expected = Template(text).safe_substitute(substitutions)
+
+        for chunk_size in (1, 2, 3, 5, 64):
+            monkeypatch.setattr(s3_module, 'STREAM_CHUNK_SIZE', chunk_size)
+            assert self.populate(text, substitutions) == ('output.txt', expected)
+
+    def test_multipart(self):
+        text = ''.join(f"INSERT INTO t VALUES ({i}, '${{foo}}', '$bar');\n" for i in range(300000))
+        output_file, output = self.populate(text, substitutions)
+        assert output == Template(text).safe_substitute(substitutions)
+        assert self.s3.head_object(Bucket='test', Key=output_file)['ETag'].endswith('-3"')
+
+    def test_part_buffer(self, monkeypatch):
+        # Below the transfer threshold, the output is still uploaded in parts: at most one is buffered.
+        s3_module.configure_transfers(threshold=s3_module.DEFAULT_TRANSFER_CONFIG['threshold'])
+        buffered = []
+        write = s3_module._MultipartWriter._write
+        monkeypatch.setattr(s3_module._MultipartWriter, '_write', lambda writer, data: write(writer, data) or buffered.append(len(writer.buffer)))
+
+        text = ''.join(f"INSERT INTO t VALUES ({i}, '${{foo}}', '$bar');\n" for i in range(300000))
+        output_file, output = self.populate(text, substitutions)
+        assert output == Template(text).safe_substitute(substitutions)
+        assert len(output) < s3_module.DEFAULT_TRANSFER_CONFIG['threshold']
+        assert max(buffered) < s3_module.MIN_PART_SIZE
+        assert self.s3.head_object(Bucket='test', Key=output_file)['ETag'].endswith('-3"')
+
+    def test_skip_unchanged(self):
+        writes = []
+        for operation in ('PutObject', 'CompleteMultipartUpload'):
+            self.s3.meta.events.register(f"before-parameter-build.s3.{operation}", lambda params, **kwargs: writes.append(params['Key']))
+
+        text = ''.join(f"INSERT INTO t VALUES ({i}, '${{foo}}');\n" for i in range(250000))
+        self.s3.put_object(Bucket='test', Key='input.txt', Body=text.encode('utf-8'))
+        self.s3.put_object(Bucket='test', Key='small.txt', Body=input)
+        writes.clear()
+
+        event = {'input_type': 'file', 'input_file': 'input.txt', 'substitutions': substitutions, 'output_type': 'file',
+                 'output_file': 'output.txt', 'bucket_name': 'test', 'skip_unchanged': True}
+        for stream in (True, True, False):
+            written = populate_template(**event, stream=stream)['written']
+            assert written == (writes == ['output.txt'])
+            writes.clear()
+        assert not written
+
+        event['input_file'] = 'small.txt'
+        assert populate_template(**event) == {'output_file': 'output.txt', 'written': True}
+        assert populate_template(**event) == {'output_file': 'output.txt', 'written': False}
+        assert populate_template(**event, stream=True) == {'output_file': 'output.txt', 'written': False}
+        assert populate_template(**dict(event, substitutions={'foo': 'changed'})) == {'output_file': 'output.txt', 'written': True}
+        assert populate_template(**dict(event, substitutions={})) == {'output_file': 'small.txt', 'written': False}
+        assert writes == ['output.txt', 'output.txt']
+
+        with pytest.raises(ValueError):
+            populate_template(**dict(event, output_type='text'))
+
+    def test_skip_unchanged_forbidden(self):
+        # Without s3:ListBucket, HEAD on a missing key is denied: the output is written anyway.
+        class Forbidden:
+            status_code = 403
+        forbidden = lambda **kwargs: (Forbidden(), {'Error': {'Code': '403', 'Message': 'Forbidden'}, 'ResponseMetadata': {'HTTPStatusCode': 403}})
+        self.s3.meta.events.register('before-call.s3.HeadObject', forbidden)
+        self.s3.put_object(Bucket='test', Key='input.txt', Body=input)
+
+        event = {'input_type': 'file', 'input_file': 'input.txt', 'substitutions': substitutions, 'output_type': 'file',
+                 'output_file': 'output.txt', 'bucket_name': 'test', 'skip_unchanged': True}
+        for stream in (False, True):
+            assert populate_template(**event, stream=stream) == {'output_file': 'output.txt', 'written': True}
+        assert self.s3.get_object(Bucket='test', Key='output.txt')['Body'].read().decode('utf-8') == output
+
+    def test_unchanged(self):
+        output_file, output = self.populate('no placeholder', substitutions)
+        assert output_file == 'input.txt'
+        assert self.s3.list_objects_v2(Bucket='test', Prefix='output')['KeyCount'] == 0
+
+#######################################################################################################
+#
+#  TestPopulateTemplates
+#
+#######################################################################################################
+@mock_s3
+class TestPopulateTemplates:
+    def test_populate_templates(self):
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        s3.put_object(Bucket='test', Key='input.txt', Body=input)
+
+        with pytest.raises(ValueError):
+            populate_templates(input_type='file', input_file='input.txt', bucket_name='test', items='foo')
+        with pytest.raises(ValueError):
+            populate_templates(input_type='file', input_text=input, bucket_name='test', items=[])
+        with pytest.raises(ValueError):
+            populate_templates(input_type='file', input_file='input.txt', bucket_name='test', items=[], max_concurrency=0)
+
+        items = ((dict(substitutions, foo=f"Lorem{i}"), f"out/{i}.txt") for i in range(100))
+        populated = populate_templates(input_type='file', input_file='input.txt', bucket_name='test', items=items, max_concurrency=4)
+        assert populated == {'output_files': [f"out/{i}.txt" for i in range(100)], 'errors': {}}
+
+        s3 = boto3.resource('s3')
+        for i in (0, 99):
+            assert s3.Object('test', f"out/{i}.txt").get()['Body'].read().decode('utf-8') == output.replace('Lorem', f"Lorem{i}")
+
+        items = [(substitutions, 'a.txt'), ({}, 'b.txt'), (substitutions, 'invalid/'), ({'foo': 1}, 'c.txt'), 'd.txt']
+        populated = populate_templates(input_type='file', input_file='input.txt', bucket_name='test', items=items)
+        assert populated['output_files'] == ['a.txt', 'input.txt', None, None, None]
+        assert set(populated['errors']) == {2, 3, 4}
+
+        populated = populate_templates(input_type='text', input_text=input, bucket_name='test', items=[({}, 'e.txt')])
+        assert populated == {'output_files': ['e.txt'], 'errors': {}}
+        assert s3.Object('test', 'e.txt').get()['Body'].read().decode('utf-8') == input
+
 #######################################################################################################
 #
 #  TestReadJsonFile
@@ -171,3 +475,242 @@ class TestReadJsonFile:
         s3.create_bucket(Bucket='test')
         s3.put_object(Bucket='test', Key='test_data.json', Body=json.dumps(some_data))
         assert some_data == read_json_file(bucket_name='test', file_key='test_data.json')
+
+    def test_read_json_file_cache(self):
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        etag = s3.put_object(Bucket='test', Key='test_data.json', Body=json.dumps(some_data))['ETag']
+        clients.set_client('s3', s3)
+        json_cache.clear()
+
+        requests = []
+        s3.meta.events.register('before-parameter-build.s3.GetObject', lambda params, **kwargs: requests.append(params.get('IfNoneMatch')))
+        try:
+            data = read_json_file(bucket_name='test', file_key='test_data.json', cache=True)
+            assert data == some_data
+            with pytest.raises(TypeError):
+                data['key1'] = 'poisoned'
+            assert read_json_file(bucket_name='test', file_key='test_data.json') is not data
+
+            assert read_json_file(bucket_name='test', file_key='test_data.json', cache=True) is data
+            assert read_json_file(bucket_name='test', file_key='test_data.json', cache_ttl=60) is data
+
+            s3.put_object(Bucket='test', Key='test_data.json', Body=json.dumps({'key1': 'changed'}))
+            assert read_json_file(bucket_name='test', file_key='test_data.json', cache_ttl=60) is data
+            assert read_json_file(bucket_name='test', file_key='test_data.json', cache=True) == {'key1': 'changed'}
+
+            assert requests == [None, None, etag, etag]
+            assert json_cache.stats() == {'entries': 1, 'bytes': len(json.dumps({'key1': 'changed'})), 'hits': 3, 'misses': 2, 'evictions': 0}
+        finally:
+            clients.reset()
+            json_cache.clear()
+
+#######################################################################################################
+#
+#  TestReadJsonFiles
+#
+#######################################################################################################
+@mock_s3
+class TestReadJsonFiles:
+    def test_read_json_files(self):
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        file_keys = [f"results/part-{i:03}.json" for i in range(200)]
+        for i, file_key in enumerate(file_keys):
+            s3.put_object(Bucket='test', Key=file_key, Body=json.dumps({'part': i}))
+        s3.put_object(Bucket='test', Key='results/invalid.json', Body='{')
+
+        with pytest.raises(ValueError):
+            read_json_files(bucket_name='test', file_keys=['results/'])
+        with pytest.raises(ValueError):
+            read_json_files(bucket_name='test', file_keys=file_keys, max_concurrency=0)
+
+        files = read_json_files(bucket_name='test', file_keys=file_keys + ['results/invalid.json', 'results/missing.json'], max_concurrency=16)
+        assert files['results'] == {file_key: {'part': i} for i, file_key in enumerate(file_keys)}
+        assert set(files['errors']) == {'results/invalid.json', 'results/missing.json'}
+        assert 'NoSuchKey' in files['errors']['results/missing.json']
+
+        assert read_json_files(bucket_name='test', file_keys=[]) == {'results': {}, 'errors': {}}
+
+#######################################################################################################
+#
+#  TestIterJson
+#
+#######################################################################################################
+some_records = [
+    {'id': 1, 'name': 'café', 'tags': ['a', 'b'], 'nested': {'list': [1, 2.5, -3e10]}},
+    12345678901234567890,
+    'text with \\ "quotes" and ünïcödé ✓',
+    None,
+    True,
+    [],
+    {}
+]
+
+@mock_s3
+class TestIterJson:
+    def test_iter_json_array(self):
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        s3.put_object(Bucket='test', Key='array.json', Body=json.dumps(some_records, indent=2, ensure_ascii=False).encode('utf-8'))
+
+        for chunk_size in (1, 7, 1024):
+            assert list(iter_json_array(bucket_name='test', file_key='array.json', chunk_size=chunk_size)) == some_records
+
+        s3.put_object(Bucket='test', Key='empty.json', Body=' [ ] ')
+        assert list(iter_json_array(bucket_name='test', file_key='empty.json')) == []
+
+        for body in ('{"a": 1}', '[1, 2', '[1, 2,]', '[1 2]', '[1] 2'):
+            s3.put_object(Bucket='test', Key='invalid.json', Body=body)
+            with pytest.raises(ValueError):
+                list(iter_json_array(bucket_name='test', file_key='invalid.json', chunk_size=2))
+
+    def test_iter_json_array_numbers(self):
+        # Chunks may end inside a fraction or an exponent ('1.', '1.5e', '-2.25E+'), not only after a number.
+        body = b'[1.5e-3, -2.25E+10, 0.125, 1e5, 10,-0.0,3.25e+2 , 7E-1]'
+        for chunk_size in range(1, len(body) + 1):
+            chunks = [body[start:start + chunk_size] for start in range(0, len(body), chunk_size)]
+            assert list(s3_module._iter_json_array(chunks)) == json.loads(body)
+
+    def test_iter_json_lines(self):
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test')
+        body = '\n'.join(json.dumps(record, ensure_ascii=False) for record in some_records) + '\n\n'
+        s3.put_object(Bucket='test', Key='records.jsonl', Body=body.encode('utf-8'))
+
+        for chunk_size in (3, 1024):
+            assert list(iter_json_lines(bucket_name='test', file_key='records.jsonl', chunk_size=chunk_size)) == some_records
+
+#######################################################################################################
+#
+#  TestTransfers
+#
+#######################################################################################################
+@pytest.mark.usefixtures('transfer_bucket')
+class TestTransfers:
+    def test_configure_transfers(self):
+        with pytest.raises(ValueError):
+            s3_module.configure_transfers(part_size=1024)
+        assert s3_module.configure_transfers(max_attempts=5)['max_attempts'] == 5
+
+    def test_read_write(self):
+        ranges = []
+        self.s3.meta.events.register('before-parameter-build.s3.GetObject', lambda params, **kwargs: ranges.append(params.get('Range')))
+
+        for size in (0, 10, s3_module.MIN_PART_SIZE, 2 * s3_module.MIN_PART_SIZE + 1):
+            body = random.Random(size).randbytes(size)
+            ranges.clear()
+            assert write_file(bucket_name='test', file_key='file.bin', body=body) == 'file.bin'
+            assert read_file(bucket_name='test', file_key='file.bin') == body
+            assert len(ranges) == (3 if size > s3_module.MIN_PART_SIZE else 1 + (size == 0))
+
+        assert self.s3.head_object(Bucket='test', Key='file.bin')['ETag'].endswith('-3"')
+
+        data = [{'id': i, 'name': f"item {i}"} for i in range(300000)]
+        write_file(bucket_name='test', file_key='data.json', body=json.dumps(data))
+        assert read_json_file(bucket_name='test', file_key='data.json') == data
+
+    def test_part_retries(self):
+        failures = {'UploadPart': 2, 'GetObject': 2}
+        second_part = (2, f"bytes={s3_module.MIN_PART_SIZE}-{2 * s3_module.MIN_PART_SIZE - 1}")
+        def fail(model, params, **kwargs):
+            if failures[model.name] and (params.get('PartNumber') or params.get('Range')) in second_part:
+                failures[model.name] -= 1
+                raise ConnectionClosedError(endpoint_url='https://s3.amazonaws.com')
+        for operation in failures:
+            self.s3.meta.events.register(f"before-parameter-build.s3.{operation}", fail)
+
+        body = random.Random(0).randbytes(3 * s3_module.MIN_PART_SIZE)
+        write_file(bucket_name='test', file_key='file.bin', body=body)
+        assert read_file(bucket_name='test', file_key='file.bin') == body
+        assert failures == {'UploadPart': 0, 'GetObject': 0}
+
+        s3_module.configure_transfers(max_attempts=1)
+        failures['UploadPart'] = 1
+        with pytest.raises(ConnectionClosedError):
+            write_file(bucket_name='test', file_key='failed.bin', body=body)
+        assert self.s3.list_multipart_uploads(Bucket='test').get('Uploads', []) == []
+
+    @pytest.mark.benchmark
+    def test_throughput(self):
+        body = random.Random(0).randbytes(8 * s3_module.MIN_PART_SIZE)
+        size = len(body) / 1024 / 1024
+
+        for label, threshold in (('single request', len(body)), ('parts', s3_module.MIN_PART_SIZE)):
+            s3_module.configure_transfers(threshold=threshold, max_concurrency=8)
+            start = time.perf_counter()
+            write_file(bucket_name='test', file_key='file.bin', body=body)
+            written = time.perf_counter()
+            assert read_file(bucket_name='test', file_key='file.bin') == body
+            read = time.perf_counter()
+            print(f"{label}: write {size / (written - start):.0f} MiB/s, read {size / (read - written):.0f} MiB/s")
+
+#######################################################################################################
+#
+#  TestCompression
+#
+#######################################################################################################
+compressors = {
+    'gzip': lambda data: gzip.compress(data, mtime=0),
+    'bzip2': bz2.compress,
+    'xz': lzma.compress
+}
+
+@pytest.mark.usefixtures('transfer_bucket')
+class TestCompression:
+    def test_write_read(self):
+        body = json.dumps(some_records).encode('utf-8') * 100
+        for codec, compress in compressors.items():
+            write_file(bucket_name='test', file_key='data.json', body=body, compression=codec)
+            assert self.s3.head_object(Bucket='test', Key='data.json')['ContentEncoding'] == codec
+            assert read_file(bucket_name='test', file_key='data.json') == body
+            raw = read_file(bucket_name='test', file_key='data.json', decompress=False)
+            assert len(raw) < len(body) and s3_module._decompress(raw, codec) == body
+
+        with pytest.raises(ValueError):
+            write_file(bucket_name='test', file_key='data.json', body=body, compression='zip')
+
+    def test_detection(self):
+        records = '\n'.join(json.dumps(record) for record in some_records).encode('utf-8')
+        array = json.dumps(some_records).encode('utf-8')
+
+        for codec, compress in compressors.items():
+            extension = s3_module.CODECS[codec]['extension']
+            # Detected from the extension, from the magic bytes, and from concatenated streams.
+            self.s3.put_object(Bucket='test', Key=f"array.json{extension}", Body=compress(array))
+            self.s3.put_object(Bucket='test', Key='array.json', Body=compress(array))
+            self.s3.put_object(Bucket='test', Key='records.jsonl', Body=compress(records[:50]) + compress(records[50:]))
+
+            for file_key in (f"array.json{extension}", 'array.json'):
+                assert read_json_file(bucket_name='test', file_key=file_key) == some_records
+                assert list(iter_json_array(bucket_name='test', file_key=file_key, chunk_size=16)) == some_records
+            assert list(iter_json_lines(bucket_name='test', file_key='records.jsonl', chunk_size=16)) == some_records
+
+        self.s3.put_object(Bucket='test', Key='truncated.json', Body=gzip.compress(array)[:-10])
+        with pytest.raises(EOFError):
+            read_json_file(bucket_name='test', file_key='truncated.json')
+
+    def test_bounded_output(self):
+        # A few KiB of zeros expand to 8 MiB per stream: each yielded piece stays at max_length.
+        body = bytes(8 * 1024 * 1024)
+        for codec, compress in compressors.items():
+            compressed = compress(body)
+            pieces = list(s3_module._decompress_chunks([compressed + compressed, b''], codec, max_length=64 * 1024))
+            assert max(len(piece) for piece in pieces) <= 64 * 1024
+            assert b''.join(pieces) == body + body
+
+    def test_populate_template(self):
+        self.s3.put_object(Bucket='test', Key='input.txt.gz', Body=gzip.compress(input.encode('utf-8')), ContentEncoding='gzip')
+        event = {'input_type': 'file', 'input_file': 'input.txt.gz', 'substitutions': substitutions, 'bucket_name': 'test'}
+        assert populate_template(**event, output_type='text') == output
+
+        for stream in (False, True):
+            populated = populate_template(**event, output_type='file', output_file='output.txt.gz', compression='gzip', skip_unchanged=True, stream=stream)
+            assert populated == {'output_file': 'output.txt.gz', 'written': not stream}
+            obj = self.s3.get_object(Bucket='test', Key='output.txt.gz')
+            assert obj['ContentEncoding'] == 'gzip'
+            assert gzip.decompress(obj['Body'].read()).decode('utf-8') == output
+
+        populated = populate_templates(input_type='file', input_file='input.txt.gz', bucket_name='test', items=[(substitutions, 'out.txt.xz')], compression='xz')
+        assert populated == {'output_files': ['out.txt.xz'], 'errors': {}}
+        assert lzma.decompress(self.s3.get_object(Bucket='test', Key='out.txt.xz')['Body'].read()).decode('utf-8') == output
@@ -1,11 +1,14 @@
+import cerberus.schema
+import ipaddress
 import os
 import pytest
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 test_dir = os.path.dirname(__file__)
 package_dir = os.path.normpath(os.path.join(test_dir, '../'))
 sys.path.append(package_dir)
-from awsomeutils.safe_kwargs import safe_kwargs
+from awsomeutils.safe_kwargs import normalize_network, safe_kwargs, validate_many
 
 #######################################################################################################
 #
@@ -41,6 +44,34 @@ class TestFunc:
         kwargs = {'input_string': 'foo', 'input_int': 123}
         assert kwargs == func(**kwargs)
 
+    def test_schema_checked_once(self, monkeypatch):
+        func(input_string='foo', input_int=0)
+
+        def validate_schema(*args, **kwargs):
+            raise AssertionError('schema checked on call')
+        monkeypatch.setattr(cerberus.schema.DefinitionSchema, 'validate', validate_schema)
+
+        for i in range(3):
+            assert func(input_string='bar', input_int=i)['input_int'] == i
+            with pytest.raises(ValueError):
+                func(input_string='bla', input_int=i)
+
+    def test_concurrent_calls(self):
+        def call(i):
+            try:
+                return func(input_string='foo' if i % 2 else 'bla', input_int=i)
+            except ValueError as e:
+                return e.args[0]
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(call, range(200)))
+
+        for i, result in enumerate(results):
+            if i % 2:
+                assert result == {'input_string': 'foo', 'input_int': i}
+            else:
+                assert result == {'input_string': ['unallowed value bla']}
+
 #######################################################################################################
 #
 #  TestClass
@@ -77,3 +108,122 @@ class TestClass:
     def test_correct_kwargs(self):
         kwargs = {'input_bool': True, 'input_list': ['a', 'b', 'c']}
         assert kwargs == c.exec(**kwargs)
+
+#######################################################################################################
+#
+#  TestValidateMany
+#
+#######################################################################################################
+class TestValidateMany:
+    def test_not_decorated(self):
+        with pytest.raises(ValueError):
+            validate_many(lambda **kwargs: kwargs, [{}])
+
+    def test_validate_many(self):
+        kwargs_list = [
+            {'input_string': 'foo', 'input_int': 1},
+            {'input_string': 'bla', 'input_int': 2},
+            {'input_int': '3'},
+            'foo'
+        ]
+        assert validate_many(func, kwargs_list) == [
+            {},
+            {'input_string': ['unallowed value bla']},
+            {'input_string': ['required field'], 'input_int': ['must be of integer type']},
+            {'kwargs': ['must be of dict type']}
+        ]
+
+    def test_validate_many_method(self):
+        kwargs_list = ({'input_bool': True, 'input_list': ['a']} for i in range(3))
+        assert validate_many(c.exec, kwargs_list) == [{}, {}, {}]
+        assert validate_many(Class.exec, [{'input_bool': True, 'input_list': [1]}]) == [{'input_list': [{0: ['must be of string type']}]}]
+
+#######################################################################################################
+#
+#  TestNetworkTypes
+#
+#######################################################################################################
+@safe_kwargs({
+    'ipv4': {'type': 'list', 'schema': {'type': 'ipv4_network'}},
+    'ipv6': {'type': 'ipv6_network'}
+})
+def network_func(**kwargs):
+    return kwargs
+
+class TestNetworkTypes:
+    def test_wrong_kwargs(self):
+        with pytest.raises(ValueError):
+            network_func(ipv4=['192.168.0.1/24'])
+
+        with pytest.raises(ValueError):
+            network_func(ipv4=['::1'])
+
+        with pytest.raises(ValueError):
+            network_func(ipv6='fe80::1/129')
+
+    def test_correct_kwargs(self):
+        kwargs = {'ipv4': ['192.168.0.1', '192.168.0.0/24', ipaddress.ip_network('10.0.0.0/8')], 'ipv6': '::1'}
+        assert kwargs == network_func(**kwargs)
+
+    def test_normalize_network(self):
+        assert normalize_network('192.168.0.1', 4) == '192.168.0.1/32'
+        assert normalize_network(ipaddress.ip_network('10.0.0.0/8'), 4) == '10.0.0.0/8'
+        assert normalize_network('2001:DB8::/32', 6) == '2001:db8::/32'
+
+        with pytest.raises(ValueError):
+            normalize_network('2001:db8::/32', 4)
+
+#######################################################################################################
+#
+#  TestCompiledEngine
+#
+#######################################################################################################
+schema = {
+    'input_string': {'required': True, 'type': 'string', 'regex': '[a-z]+', 'minlength': 2, 'allowed': ['foo', 'bar', 'x']},
+    'input_list': {'type': 'list', 'minlength': 1, 'schema': {'type': 'dict', 'schema': {
+        'id': {'required': True, 'type': 'integer'},
+        'tags': {'type': 'list', 'allowed': ['a', 'b'], 'nullable': True}}}},
+    'input_dict': {'type': 'dict', 'keysrules': {'type': 'string', 'regex': '[a-z]+'}, 'valuesrules': {'type': ['integer', 'string']}},
+    'input_mode': {'type': 'string', 'oneof': [{'allowed': ['a'], 'dependencies': 'input_dict'}, {'allowed': ['b']}], 'excludes': 'input_other'},
+    'input_other': {'required': True, 'type': 'integer'},
+    'input_items': {'type': 'iterable'}
+}
+
+@safe_kwargs(schema)
+def cerberus_func(**kwargs):
+    return kwargs
+
+@safe_kwargs(schema, engine='compiled')
+def compiled_func(**kwargs):
+    return kwargs
+
+documents = [
+    {},
+    {'input_string': 'foo', 'input_other': 1},
+    {'input_string': None, 'input_other': '1'},
+    {'input_string': 'x', 'input_list': []},
+    {'input_string': 'Foo', 'input_list': [{'id': 1, 'tags': ['a', 'c']}, {'tags': None}, 'bar', {'id': True}]},
+    {'input_string': 'bar', 'input_dict': {'a': 1, 'B': 2.5, 3: 'c'}, 'input_mode': 'a', 'input_other': 1},
+    {'input_string': 'bar', 'input_mode': 'a'},
+    {'input_string': 'bar', 'input_mode': 'c', 'input_dict': 'a'},
+    {'input_string': 123, 'input_mode': 'b', 'unknown': True},
+    {'input_string': 'foo', 'input_other': 1, 'input_items': (item for item in [1, 2])},
+    {'input_string': 'foo', 'input_other': 1, 'input_items': 'ab'},
+    {'input_string': 'foo', 'input_other': 1, 'input_items': {'a': 1}}
+]
+
+class TestCompiledEngine:
+    def test_unknown_engine(self):
+        with pytest.raises(ValueError):
+            safe_kwargs(schema, engine='foo')
+
+    @pytest.mark.parametrize('document', documents)
+    def test_same_errors(self, document):
+        def errors(func):
+            try:
+                func(**document)
+                return {}
+            except ValueError as e:
+                return e.args[0]
+
+        assert errors(compiled_func) == errors(cerberus_func)
@@ -1,6 +1,8 @@
 import boto3
+import ipaddress
 import os
 import pytest
+import random
 import sys
 from moto import mock_ec2
 
@@ -9,7 +11,8 @@ os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
 test_dir = os.path.dirname(__file__)
 package_dir = os.path.normpath(os.path.join(test_dir, '../'))
 sys.path.append(package_dir)
-from awsomeutils.security_group import update_security_group
+from awsomeutils import clients, security_group
+from awsomeutils.security_group import update_security_group, update_security_groups
 
 #######################################################################################################
 #
@@ -54,8 +57,22 @@ class TestUpdateSecurityGroup:
         with pytest.raises(ValueError):
             update_security_group(security_group_id=sg_id, port=123, protocol='tcp', allowed_ipv4_addresses=[])
 
+        with pytest.raises(ValueError):
+            update_security_group(security_group_id=sg_id, port=123, protocol='tcp', allowed_ipv4_addresses=['192.168.0.1/24'], allowed_ipv6_addresses=[])
+
+        with pytest.raises(ValueError):
+            update_security_group(security_group_id=sg_id, port=123, protocol='tcp', allowed_ipv4_addresses=[], allowed_ipv6_addresses=['192.168.0.1/32'])
+
         assert update_security_group(security_group_id=sg_id, port=123, protocol='tcp', allowed_ipv4_addresses=[], allowed_ipv6_addresses=[])
 
+    def test_normalize(self):
+        ec2 = boto3.client('ec2')
+        sg_id = ec2.create_security_group(Description='test', GroupName='test_normalize')['GroupId']
+
+        result = update_security_group(security_group_id=sg_id, port=123, protocol='tcp', allowed_ipv4_addresses=['192.168.0.1'], allowed_ipv6_addresses=['2001:DB8::1'])
+        assert result['authorized_ipv4_addresses'] == ['192.168.0.1/32']
+        assert result['authorized_ipv6_addresses'] == ['2001:db8::1/128']
+
     def test_update(self):
         ec2 = boto3.client('ec2')
         sg_id = ec2.create_security_group(Description='test', GroupName='test_update')['GroupId']
@@ -84,3 +101,100 @@ class TestUpdateSecurityGroup:
         event['allowed_ipv4_addresses'] = []
         expected_result['revoked_ipv4_addresses'] = [ipv4_addresses[0]]
         assert update_security_group(security_group_id=sg_id, **event) == expected_result
+
+    def test_aggregate(self):
+        ec2 = boto3.client('ec2')
+        sg_id = ec2.create_security_group(Description='test', GroupName='test_aggregate')['GroupId']
+        singles = [f"192.168.1.{i}/32" for i in range(16)]
+        rule = dict(event, allowed_ipv4_addresses=singles[:10], allowed_ipv6_addresses=['2001:db8::/128', '2001:db8::1/128'])
+        update_security_group(security_group_id=sg_id, **rule)
+
+        # The /32 covered by the /28 are replaced by it.
+        result = update_security_group(security_group_id=sg_id, **dict(rule, allowed_ipv4_addresses=singles[:10] + ['192.168.1.0/28']), aggregate=True)
+        assert sorted(result['revoked_ipv4_addresses']) == sorted(singles[:10]) and result['authorized_ipv4_addresses'] == ['192.168.1.0/28']
+        assert sorted(result['revoked_ipv6_addresses']) == ['2001:db8::/128', '2001:db8::1/128'] and result['authorized_ipv6_addresses'] == ['2001:db8::/127']
+
+        # The same addresses, listed differently, change nothing.
+        result = update_security_group(security_group_id=sg_id, **dict(rule, allowed_ipv4_addresses=list(reversed(singles))), aggregate=True)
+        assert result == dict(expected_result, authorized_ipv4_addresses=[], revoked_ipv4_addresses=[])
+
+    def test_collapse(self):
+        generator = random.Random(25)
+        for i in range(200):
+            version = generator.choice([4, 6])
+            if version == 4:
+                networks = [ipaddress.ip_network(f"10.0.{generator.randrange(4)}.{generator.randrange(256)}/{generator.randint(22, 32)}", strict=False) for _ in range(generator.randint(0, 200))]
+            else:
+                networks = [ipaddress.ip_network(f"2001:db8::{generator.randrange(1024):x}/{generator.randint(116, 128)}", strict=False) for _ in range(generator.randint(0, 200))]
+            expected = [str(network) for network in ipaddress.collapse_addresses(networks)]
+            assert security_group._collapse([str(network) for network in networks], version) == expected
+        assert security_group._collapse(['0.0.0.0/0', '10.0.0.0/8'], 4) == ['0.0.0.0/0']
+
+        addresses = [f"10.{generator.randrange(4)}.{generator.randrange(256)}.{generator.randrange(256)}/32" for _ in range(50000)]
+        expected = [str(network) for network in ipaddress.collapse_addresses(ipaddress.ip_network(address) for address in addresses)]
+        assert security_group._collapse(addresses, 4) == expected
+
+#######################################################################################################
+#
+#  TestUpdateSecurityGroups
+#
+#######################################################################################################
+@mock_ec2
+class TestUpdateSecurityGroups:
+    def setup_method(self, method):
+        self.ec2 = boto3.client('ec2')
+        clients.set_client('ec2', self.ec2)
+        self.calls = []
+        self.ec2.meta.events.register('before-call.ec2', lambda model, **kwargs: self.calls.append(model.name))
+
+    def teardown_method(self, method):
+        clients.reset()
+
+    def rules(self, group_ids, ports, ipv4_addresses):
+        return [{'security_group_id': group_id, 'port': port, 'protocol': 'tcp', 'allowed_ipv4_addresses': ipv4_addresses, 'allowed_ipv6_addresses': []}
+                for group_id in group_ids for port in ports]
+
+    def test_update(self):
+        group_ids = [self.ec2.create_security_group(Description='test', GroupName=f"test_batch{i}")['GroupId'] for i in range(5)]
+        update_security_group(**self.rules(group_ids[:1], [22], ipv4_addresses[:2])[0])
+        self.calls.clear()
+
+        rules = self.rules(group_ids, [22, 443, 5432], ipv4_addresses[1:])
+        rules.append(dict(rules[0], protocol='udp', allowed_ipv6_addresses=['2001:db8::1']))
+        reports = update_security_groups(rules=rules)
+
+        # One describe call, then only authorize calls: the first group also has a revoke call.
+        assert self.calls.count('DescribeSecurityGroups') == 1
+        assert self.calls.count('RevokeSecurityGroupIngress') == 1
+        assert self.calls.count('AuthorizeSecurityGroupIngress') == 5
+        assert reports[0] == dict(expected_result, port=22, revoked_ipv4_addresses=[ipv4_addresses[0]], authorized_ipv4_addresses=[ipv4_addresses[2]])
+        assert sorted(reports[1]['authorized_ipv4_addresses']) == ipv4_addresses[1:]
+        assert reports[-1]['protocol'] == 'udp' and reports[-1]['authorized_ipv6_addresses'] == ['2001:db8::1/128']
+
+        # Reconciled: the same desired state changes nothing.
+        self.calls.clear()
+        reports = update_security_groups(rules=rules)
+        assert self.calls == ['DescribeSecurityGroups']
+        assert all(not report[key] for report in reports for key in report if key.endswith('addresses'))
+        assert update_security_group(**rules[7])['authorized_ipv4_addresses'] == []
+
+    def test_aggregate(self):
+        group_ids = [self.ec2.create_security_group(Description='test', GroupName=f"test_batch_aggregate{i}")['GroupId'] for i in range(2)]
+        rules = self.rules(group_ids, [22], [f"10.0.0.{i}/32" for i in range(8)])
+        rules[1]['aggregate'] = False
+
+        reports = update_security_groups(rules=rules, aggregate=True)
+        assert reports[0]['authorized_ipv4_addresses'] == ['10.0.0.0/29']
+        assert len(reports[1]['authorized_ipv4_addresses']) == 8
+
+    def test_errors(self):
+        group_id = self.ec2.create_security_group(Description='test', GroupName='test_batch_errors')['GroupId']
+        rules = self.rules([group_id], [22], ipv4_addresses)
+
+        with pytest.raises(ValueError):
+            update_security_groups(rules=rules + rules)
+        with pytest.raises(ValueError):
+            update_security_groups(rules=rules + self.rules(['sg-00000000000000000'], [22], ipv4_addresses))
+        with pytest.raises(ValueError):
+            update_security_groups(rules=[dict(rules[0], allowed_ipv4_addresses=['2001:db8::1'])])
+        assert 'AuthorizeSecurityGroupIngress' not in self.calls
@@ -0,0 +1,46 @@
+import os
+import random
+import sys
+from string import Template
+
+test_dir = os.path.dirname(__file__)
+package_dir = os.path.normpath(os.path.join(test_dir, '../'))
+sys.path.append(package_dir)
+from awsomeutils.template import CompiledTemplate, compile_template, template_cache
+
+#######################################################################################################
+#
+#  TestCompiledTemplate
+#
+#######################################################################################################
+class TestCompiledTemplate:
+    def test_substitute(self):
+        template = CompiledTemplate('Hello ${name}, $name! $$name costs $$5 $ ${missing} $unknown ${ bad} $1')
+        assert template.names == {'name', 'missing', 'unknown'}
+        assert template.substitute({'name': 'World', 'unknown': 1}) == 'Hello World, World! $name costs $5 $ ${missing} 1 ${ bad} $1'
+        assert template.text == 'Hello ${name}, $name! $$name costs $$5 $ ${missing} $unknown ${ bad} $1'
+
+    def test_safe_substitute_parity(self):
+        rng = random.Random(42)
+        tokens = ['$', '$$', '{', '}', 'a', 'b_1', ' ', '\n', '1', '${a}', '$b_1', 'é', '${', '$A']
+        mapping = {'a': 'x$y', 'b_1': '${a}', 'A': ''}
+
+        for i in range(2000):
+            text = ''.join(rng.choice(tokens) for j in range(rng.randint(0, 12)))
+            template = CompiledTemplate(text)
+            assert template.substitute(mapping) == Template(text).safe_substitute(mapping), text
+            assert template.text == text
+
+#######################################################################################################
+#
+#  TestCompileTemplate
+#
+#######################################################################################################
+class TestCompileTemplate:
+    def test_cache(self):
+        template_cache.clear()
+        template = compile_template('Hello $name')
+        assert compile_template('Hello $name') is template
+        assert compile_template('Bye $name') is not template
+        assert template_cache.stats() == {'entries': 2, 'bytes': 20, 'hits': 1, 'misses': 2, 'evictions': 0}
+        template_cache.clear()